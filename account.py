@@ -5,6 +5,7 @@ Module for managing users and groups.
 Copyright (C) 2017 Davide Madrisan <davide.madrisan.gmail.com>
 '''
 # Import python libs
+import os
 from collections import namedtuple
 
 # Import salt libs
@@ -14,6 +15,152 @@ from salt.exceptions import CommandExecutionError
 # Define the module's virtual name
 __virtualname__ = 'account'
 
+file_group = '/etc/group'
+file_user = '/etc/passwd'
+
+Group = namedtuple('Group', ('groupname', 'passwd', 'gid', 'grouplist'))
+User = namedtuple('User',
+    ('username', 'passwd', 'uid', 'gid', 'gecos', 'homedir', 'shell'))
+
+# Parsed tables are kept for the whole life of the minion process and
+# invalidated as soon as the underlying file changes on disk
+_parse_cache = {}
+_cache_counters = {'hits': 0, 'misses': 0}
+
+def _file_signature(filename):
+    '''
+    Return a tuple that changes whenever 'filename' is modified or replaced
+    '''
+    st = os.stat(filename)
+    mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+    return (st.st_dev, st.st_ino, mtime, st.st_size)
+
+def _fresh_cache(filename, parser):
+    '''
+    Return the cached output of 'parser(filename)' if the file has not
+    changed since it has been parsed, None otherwise
+    '''
+    try:
+        signature = _file_signature(filename)
+    except OSError:
+        return None
+    cached = _parse_cache.get((filename, parser.__name__))
+    if cached and cached[0] == signature:
+        _cache_counters['hits'] += 1
+        return cached[1]
+    return None
+
+def _cached_parse(filename, parser):
+    '''
+    Return the output of 'parser(filename)', parsing the file again only
+    when its signature has changed since the last call.
+    The returned object is shared between callers and must not be modified.
+    '''
+    data = _fresh_cache(filename, parser)
+    if data is not None:
+        return data
+
+    try:
+        signature = _file_signature(filename)
+    except OSError:
+        raise CommandExecutionError(
+            'An error has occurred while reading {0}'.format(filename)
+        )
+    _cache_counters['misses'] += 1
+    data = parser(filename)
+    _parse_cache[(filename, parser.__name__)] = (signature, data)
+    return data
+
+def _copy_entry(entry):
+    '''
+    Return a copy of the cached user or group 'entry', so that the
+    callers can modify it without altering the cache
+    '''
+    return dict((field, list(value) if isinstance(value, list) else value)
+        for field, value in entry.items())
+
+def _as_list(names):
+    '''
+    Accept both a python list and a comma separated string (CLI usage)
+    '''
+    if hasattr(names, 'split'):
+        return [name for name in names.split(',') if name]
+    return list(names)
+
+def _iter_file(filename, parse_line):
+    try:
+        with salt.utils.fopen(filename, 'r') as fp_:
+            for line in fp_:
+                if line.strip():
+                    yield parse_line(line)
+    except (IOError, OSError, TypeError):
+        raise CommandExecutionError(
+            'An error has occurred while reading {0}'.format(filename)
+        )
+
+def _iter_groups():
+    '''
+    Yield the entries of /etc/group as Group tuples
+    '''
+    return _iter_file(file_group, lambda line: Group(*line.split(':')))
+
+def _iter_users():
+    '''
+    Yield the entries of /etc/passwd as (User, raw line) tuples
+    '''
+    return _iter_file(file_user,
+        lambda line: (User(*line.rstrip().split(':')), line.rstrip('\n')))
+
+def _secondary_groups(group):
+    grouplist = group.grouplist.strip()
+    return grouplist.split(',') if len(grouplist) > 0 else ''
+
+def _pack_group(group):
+    secgroups = _secondary_groups(group)
+    return dict(
+        gid = int(group.gid), grouplist = secgroups
+    ) if secgroups else dict(gid = int(group.gid))
+
+def _pack_user(user):
+    return dict(
+        uid = int(user.uid),
+        gid = int(user.gid),
+        gecos = user.gecos,
+        homedir = user.homedir,
+        shell = user.shell)
+
+def _parse_group_file(filename):
+    '''
+    Return the content of /etc/group as a tuple of three indexes built
+    in a single pass: by group name, by gid and by member name
+    '''
+    groups, by_gid, by_member = {}, {}, {}
+    for group in _iter_groups():
+        data = _pack_group(group)
+        groups[group.groupname] = data
+        by_gid.setdefault(data['gid'], []).append(group.groupname)
+        for member in data.get('grouplist', []):
+            by_member.setdefault(member, []).append(group.groupname)
+    return (groups, by_gid, by_member)
+
+def _parse_passwd_file(filename):
+    return dict((user.username, _pack_user(user))
+        for user, _ in _iter_users())
+
+def _find_users(names):
+    '''
+    Scan /etc/passwd until all the users 'names' have been found and
+    return a dictionary (key = username, value = (User, raw line))
+    '''
+    wanted = set(names)
+    found = {}
+    for user, line in _iter_users():
+        if user.username in wanted and user.username not in found:
+            found[user.username] = (user, line)
+            if len(found) == len(wanted):
+                break
+    return found
+
 def get_group_list():
     '''
     Return the list of the groups configured in /etc/group
@@ -24,26 +171,8 @@ def get_group_list():
 
             salt '*' account.get_group_list
     '''
-    file_group = '/etc/group'
-    tokens = ('groupname', 'passwd', 'gid', 'grouplist')
-    Group = namedtuple('Group', tokens)
-    try:
-        with salt.utils.fopen(file_group, 'r') as fp_:
-            group_infos = list(Group(*line.split(':')) for line in fp_)
-    except:
-        raise CommandExecutionError(
-            'An error has occurred while reading {0}'.format(file_group)
-        )
-
-    def _secondary_groups(group):
-        grouplist = group.grouplist.strip()
-        return grouplist.split(',') if len(grouplist) > 0 else ''
-    def _pack_data(group):
-        secgroups = _secondary_groups(group)
-        return dict(
-            gid = int(group.gid), grouplist = secgroups
-        ) if secgroups else dict(gid = int(group.gid))
-    return dict((group.groupname, _pack_data(group)) for group in group_infos)
+    groups = _cached_parse(file_group, _parse_group_file)[0]
+    return dict((name, _copy_entry(data)) for name, data in groups.items())
 
 def get_user_list():
     '''
@@ -55,25 +184,124 @@ def get_user_list():
 
             salt '*' account.get_user_list
     '''
-    file_user = '/etc/passwd'
-    tokens = ('username', 'passwd', 'uid', 'gid', 'gecos', 'homedir', 'shell')
-    User = namedtuple('User', tokens)
-    try:
-        with salt.utils.fopen(file_user, 'r') as fp_:
-            user_infos = list(User(*line.rstrip().split(':')) for line in fp_)
-    except:
-        raise CommandExecutionError(
-            'An error has occurred while reading {0}'.format(file_user)
-        )
+    users = _cached_parse(file_user, _parse_passwd_file)
+    return dict((name, _copy_entry(data)) for name, data in users.items())
+
+def get_users(names):
+    '''
+    Return the /etc/passwd informations of the users 'names' only.
+    The file is read until all the requested users have been found.
+
+    CLI Example:
+
+        .. code-block:: bash
+
+            salt '*' account.get_users oracle,grid
+    '''
+    wanted = set(_as_list(names))
+    users = _fresh_cache(file_user, _parse_passwd_file)
+    if users is not None:
+        return dict((name, _copy_entry(users[name]))
+            for name in wanted if name in users)
+
+    return dict((name, _pack_user(user))
+        for name, (user, _) in _find_users(wanted).items())
+
+def get_group_by_gid(gid):
+    '''
+    Return the first group in /etc/group having the given 'gid'
+    (like getgrgid(3) does), or an empty dictionary.
+
+    CLI Example:
+
+        .. code-block:: bash
+
+            salt '*' account.get_group_by_gid 501
+    '''
+    gid = int(gid)
+    indexes = _fresh_cache(file_group, _parse_group_file)
+    if indexes is not None:
+        groups, by_gid, _ = indexes
+        names = by_gid.get(gid)
+        return { names[0]: _copy_entry(groups[names[0]]) } if names else {}
+
+    for group in _iter_groups():
+        if int(group.gid) == gid:
+            return { group.groupname: _pack_group(group) }
+    return {}
+
+def _memberships(user_infos):
+    '''
+    Return the primary group and the secondary groups of the users
+    described by the dictionary 'user_infos' (see _pack_user)
+    '''
+    gids = set(data['gid'] for data in user_infos.values())
+    primary, secondary = {}, dict((user, []) for user in user_infos)
+
+    indexes = _fresh_cache(file_group, _parse_group_file)
+    if indexes is not None:
+        _, by_gid, by_member = indexes
+        for gid in gids:
+            if gid in by_gid:
+                primary[gid] = by_gid[gid][0]
+        for user in user_infos:
+            secondary[user] = list(by_member.get(user, []))
+    else:
+        for group in _iter_groups():
+            gid = int(group.gid)
+            if gid in gids and gid not in primary:
+                primary[gid] = group.groupname
+            for member in _secondary_groups(group):
+                if member in secondary:
+                    secondary[member].append(group.groupname)
 
     def _pack_data(user):
+        gid = user_infos[user]['gid']
+        group = primary.get(gid, '')
         return dict(
-            uid = int(user.uid),
-            gid = int(user.gid),
-            gecos = user.gecos,
-            homedir = user.homedir,
-            shell = user.shell)
-    return dict((user.username, _pack_data(user)) for user in user_infos)
+            gid = gid,
+            group = group,
+            secgroups = [grp for grp in secondary[user] if grp != group])
+    return dict((user, _pack_data(user)) for user in user_infos)
+
+def get_memberships(users):
+    '''
+    Return the primary group and the secondary groups of 'users'.
+    Unknown users are not reported.
+
+    CLI Example:
+
+        .. code-block:: bash
+
+            salt '*' account.get_memberships oracle,grid
+    '''
+    return _memberships(get_users(users))
+
+def audit_users(users):
+    '''
+    Return, in a single call, the primary group, the secondary groups,
+    the shell, the home directory and the raw /etc/passwd line of 'users'.
+    Unknown users are not reported.
+
+    CLI Example:
+
+        .. code-block:: bash
+
+            salt '*' account.audit_users oracle,grid
+    '''
+    found = _find_users(_as_list(users))
+    memberships = _memberships(
+        dict((name, _pack_user(user)) for name, (user, _) in found.items()))
+
+    def _pack_data(name):
+        user, line = found[name]
+        return dict(
+            group = memberships[name]['group'],
+            secgroups = memberships[name]['secgroups'],
+            shell = user.shell,
+            home = user.homedir,
+            raw = line)
+    return dict((name, _pack_data(name)) for name in found)
 
 def get_passwd_raw():
     '''
@@ -85,7 +313,6 @@ def get_passwd_raw():
 
             salt '*' account.get_passwd_raw
     '''
-    file_user = '/etc/passwd'
     try:
         with salt.utils.fopen(file_user, 'r') as fp_:
             content = [line for line in fp_]
@@ -94,3 +321,19 @@ def get_passwd_raw():
             'An error has occurred while reading {0}'.format(file_user)
         )
     return content
+
+def cache_stats():
+    '''
+    Return the hit and miss counters of the cache holding the parsed
+    /etc/passwd and /etc/group files
+
+    CLI Example:
+
+        .. code-block:: bash
+
+            salt '*' account.cache_stats
+    '''
+    return dict(
+        hits = _cache_counters['hits'],
+        misses = _cache_counters['misses'],
+        entries = len(_parse_cache))
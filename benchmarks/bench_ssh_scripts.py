@@ -0,0 +1,362 @@
+#!/usr/bin/python
+# Offline benchmarks for check_account.py and scripts/check_cluster.py
+# Copyright (C) 2017 Davide Madrisan <davide.madrisan.gmail.com>
+
+from __future__ import print_function
+
+__author__ = "Davide Madrisan"
+__copyright__ = "Copyright 2017 Davide Madrisan"
+__license__ = "GPL"
+__version__ = "1"
+__email__ = "davide.madrisan.gmail.com"
+__status__ = "Beta"
+
+# Import python libs
+import getopt
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import types
+
+# PyYAML is a SaltStack dependency, used to parse the arguments the way
+# the remote salt-call does
+import yaml
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def die(message, exitcode=1):
+    '''
+    Print an error message and exit with the given 'exitcode'
+    '''
+    progname = sys.argv[0]
+    print('{0}: error: {1}'.format(progname, message), file=sys.stderr)
+    sys.exit(exitcode)
+
+def usage():
+    progname = sys.argv[0]
+    for line in [
+        'Offline benchmarks of the salt-ssh driver scripts',
+        'Copyright (C) 2017 Davide Madrisan <davide.madrisan.gmail.com>',
+        'Usage:',
+        '\t' + progname + ' [--hosts <N>[,<N2>,...]] [--users <M>[,<M2>,...]]'
+            ' [--services <S>]',
+        '\t\t[--latency <seconds>] [--jitter <seconds>] [--jobs <J>]'
+            ' [--drift <ratio>]',
+        '\t' + progname + ' -h',
+        'Example:\n' + '\t%s -n 10,50 -m 1000 -l 0.3 -j 16' % progname ]:
+        print(line)
+
+def install_salt_standin():
+    '''
+    Make the driver scripts importable when SaltStack is not installed:
+    only the names they use at import time are provided
+    '''
+    try:
+        import salt.client.ssh.client
+        return
+    except ImportError:
+        pass
+
+    class CommandExecutionError(Exception):
+        pass
+
+    modules = dict((name, types.ModuleType(name)) for name in (
+        'salt', 'salt.client', 'salt.client.ssh', 'salt.client.ssh.client',
+        'salt.exceptions', 'salt.utils'))
+    modules['salt.exceptions'].CommandExecutionError = CommandExecutionError
+    modules['salt.utils'].fopen = open
+    modules['salt'].client = modules['salt.client']
+    modules['salt'].exceptions = modules['salt.exceptions']
+    modules['salt'].utils = modules['salt.utils']
+    modules['salt.client'].ssh = modules['salt.client.ssh']
+    modules['salt.client.ssh'].client = modules['salt.client.ssh.client']
+    modules['salt.client.ssh.client'].SSHClient = None
+    sys.modules.update(modules)
+
+class FakeFleet(object):
+    '''
+    A set of synthetic hosts.  All the hosts share the same tables but a
+    'drift' fraction of them, that has one user with a different shell
+    and one extra group.
+    '''
+    def __init__(self, users, services, drift=0.0):
+        self.users = dict(('user{0:05d}'.format(n), {
+            'uid': 1000 + n, 'gid': 1000 + n % 100, 'gecos': '',
+            'homedir': '/home/user{0:05d}'.format(n), 'shell': '/bin/bash'})
+                for n in range(users))
+        self.groups = dict(('group{0:03d}'.format(n), {
+            'gid': 1000 + n, 'grouplist': sorted(self.users)[n::100][:50]})
+                for n in range(100))
+        self.services = dict(('{0}/{1}'.format(port, proto), {
+            'name': 'svc{0}'.format(port), 'port': str(port),
+            'protocol': proto})
+                for port in range(1, services // 2 + 1)
+                    for proto in ('tcp', 'udp'))
+        self.grains = {'osarch': 'x86_64', 'osrelease_info': [7, 4],
+                       'osfullname': 'Red Hat Enterprise Linux Server',
+                       'padding': 'x' * 200 * 1024}
+        self.drift = drift
+
+    def is_drifted(self, target):
+        return random.Random(target).random() < self.drift
+
+    def functions(self, target):
+        '''
+        Return the synthetic execution module functions of 'target'
+        '''
+        users, groups = self.users, self.groups
+        if self.is_drifted(target):
+            users, groups = dict(users), dict(groups)
+            name = sorted(users)[0]
+            users[name] = dict(users[name], shell='/bin/ksh')
+            groups['extra_' + target] = {'gid': 99999}
+
+        def audit_users(names):
+            names = names.split(',') if hasattr(names, 'split') else names
+            return dict((name, {
+                'group': 'group{0:03d}'.format(users[name]['gid'] % 100),
+                'secgroups': [],
+                'shell': users[name]['shell'],
+                'home': users[name]['homedir'],
+                'raw': '{0}:x:{1}:{2}::{3}:{4}'.format(name,
+                    users[name]['uid'], users[name]['gid'],
+                    users[name]['homedir'], users[name]['shell'])})
+                        for name in names if name in users)
+
+        return {
+            'account.audit_users': audit_users,
+            'account.get_group_list': lambda: groups,
+            'account.get_user_list': lambda: users,
+            'cluster.is_active': lambda: (True, 'Pacemaker Cluster'),
+            'grains.items': lambda: self.grains,
+            'service_iana.get_service_list': lambda: self.services,
+        }
+
+class FakeRemote(object):
+    '''
+    The simulated remote side: latency, payload synthesis and statistics
+    '''
+    def __init__(self, fleet, latency=0.2, jitter=0.05):
+        self.fleet, self.latency, self.jitter = fleet, latency, jitter
+        self.lock = threading.Lock()
+        # the execution modules of this repository run "remotely" in a
+        # private namespace per call, so that the threads never share
+        # their __salt__ and __grains__ globals
+        self.modules = dict()
+        for name in ('cluster_check',):
+            filename = os.path.join(basedir, name + '.py')
+            with open(filename) as fp_:
+                self.modules[name] = compile(fp_.read(), filename, 'exec')
+        self.reset()
+
+    def reset(self):
+        self.calls, self.bytes, self.errors = 0, 0, []
+
+    def run(self, target, fun, arg, kwarg):
+        functions = self.fleet.functions(target)
+        modname, _, funname = fun.partition('.')
+        if modname in self.modules:
+            namespace = {'__name__': modname,
+                         '__salt__': functions,
+                         '__grains__': self.fleet.grains}
+            exec(self.modules[modname], namespace)
+            return namespace[funname](*arg, **(kwarg or {}))
+        return functions[fun](*arg, **(kwarg or {}))
+
+    def cmd(self, target, fun, arg=(), kwarg=None):
+        start = time.time()
+        try:
+            ret = {target: {'return': self.run(target, fun, arg, kwarg)}}
+        except Exception as err:
+            ret = {target: {'stderr': str(err), 'stdout': ''}}
+            with self.lock:
+                self.errors.append('{0}: {1}'.format(fun, err))
+        # what travels back through the ssh channel
+        payload = json.dumps(ret)
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        time.sleep(max(0, delay - (time.time() - start)))
+        with self.lock:
+            self.calls += 1
+            self.bytes += len(payload)
+        return json.loads(payload)
+
+def ssh_argv(arg, kwarg):
+    '''
+    Return the command line built by salt-ssh for the arguments 'arg' and
+    'kwarg': the keyword arguments are appended as a dictionary, and every
+    dictionary is turned into key=value strings
+    '''
+    argv = []
+    for value in list(arg) + ([kwarg] if kwarg else []):
+        if isinstance(value, dict):
+            argv.extend('{0}={1}'.format(key, val)
+                for key, val in value.items() if key != '__kwarg__')
+        else:
+            argv.append(str(value))
+    return argv
+
+def yamlify_arg(value):
+    '''
+    Load the command line argument 'value' as YAML, keeping the original
+    string when it is not a plain python type
+    '''
+    try:
+        loaded = yaml.safe_load(value)
+    except yaml.YAMLError:
+        return value
+    if loaded is None and value.strip() not in ('None', 'null', '~'):
+        return value
+    if not isinstance(loaded, (dict, list, bool, int, float, str, type(None))):
+        return value
+    return loaded
+
+def parse_argv(argv):
+    '''
+    Return the positional and keyword arguments parsed from the command
+    line 'argv', as done by the remote salt-call
+    '''
+    args, kwargs = [], {}
+    for value in argv:
+        match = re.match(r'^([^\d\W][\w.-]*)=(?!=)(.*)$', value, re.UNICODE)
+        if match:
+            kwargs[match.group(1)] = yamlify_arg(match.group(2))
+        else:
+            args.append(yamlify_arg(value))
+    return (args, kwargs)
+
+remote = None
+
+class FakeSSHClient(object):
+    '''
+    Stand-in for salt.client.ssh.client.SSHClient.  The arguments go
+    through the same command line conversion as with salt-ssh.
+    '''
+    def cmd(self, tgt, fun, arg=(), timeout=None, tgt_type='glob',
+            kwarg=None, **kwargs):
+        return remote.cmd(tgt, fun, *parse_argv(ssh_argv(arg, kwarg)))
+
+    def cmd_iter(self, tgt, fun, arg=(), timeout=None, tgt_type='glob',
+                 ret='', kwarg=None, **kwargs):
+        yield remote.cmd(tgt, fun, *parse_argv(ssh_argv(arg, kwarg)))
+
+def measure(func):
+    '''
+    Run 'func' with its standard output discarded and return the tuple
+    (wall time, remote calls, bytes received, peak memory in bytes,
+    errors raised by the remote functions).
+    The peak memory is measured in a second run without any latency,
+    because tracing the allocations slows down the execution.
+    '''
+    def _run():
+        remote.reset()
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        start = time.time()
+        try:
+            func()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        return time.time() - start
+
+    elapsed = _run()
+    calls, received, errors = remote.calls, remote.bytes, remote.errors
+    if not tracemalloc:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return (elapsed, calls, received, peak, errors)
+
+    latency, jitter = remote.latency, remote.jitter
+    remote.latency, remote.jitter = 0, 0
+    tracemalloc.start()
+    try:
+        _run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        remote.latency, remote.jitter = latency, jitter
+    return (elapsed, calls, received, peak, errors)
+
+def main(hosts_list, users_list, services, latency, jitter, jobs, drift):
+    global remote
+    install_salt_standin()
+    sys.path[:0] = [basedir, os.path.join(basedir, 'scripts')]
+    import salt.client.ssh.client
+    salt.client.ssh.client.SSHClient = FakeSSHClient
+    import check_account
+    import check_cluster
+
+    print('{0:<28} {1:>6} {2:>7} {3:>9} {4:>7} {5:>11} {6:>11}'.format(
+        'benchmark', 'hosts', 'users', 'wall (s)', 'calls',
+        'received', 'peak mem'))
+    for users in users_list:
+        fleet = FakeFleet(users, services, drift)
+        remote = FakeRemote(fleet, latency, jitter)
+        audited = sorted(fleet.users)[:30]
+        for hosts in hosts_list:
+            targets = ['host{0:04d}'.format(n) for n in range(hosts)]
+            benchmarks = [
+                ('check_account (30 users)',
+                    lambda: check_account.main(targets, audited, jobs)),
+                ('check_cluster',
+                    lambda: check_cluster.main(targets, jobs)),
+                ('check_cluster --majority',
+                    lambda: check_cluster.main(targets, jobs, True)),
+            ]
+            for name, func in benchmarks:
+                elapsed, calls, received, peak, errors = measure(func)
+                for error in sorted(set(errors)):
+                    print('{0}: warning: {1}: {2}'.format(
+                        sys.argv[0], name, error), file=sys.stderr)
+                print('{0:<28} {1:>6} {2:>7} {3:>9.2f} {4:>7} {5:>9.1f}kB '
+                      '{6:>9.1f}MB'.format(name, hosts, users, elapsed,
+                          calls, received / 1024.0, peak / 1048576.0))
+
+if __name__ == '__main__':
+    hosts_list, users_list, services = [10], [1000], 10000
+    latency, jitter, jobs, drift = 0.2, 0.05, 8, 0.1
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:hj:l:m:n:s:x:',
+            ["drift=", "help", "jitter=", "jobs=", "latency=", "users=",
+             "hosts=", "services="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    try:
+        for o, a in opts:
+            if o in ('-h', '--help'):
+                usage()
+                sys.exit()
+            elif o in ('-d', '--drift'):
+                drift = float(a)
+            elif o in ('-j', '--jobs'):
+                jobs = int(a)
+            elif o in ('-l', '--latency'):
+                latency = float(a)
+            elif o in ('-m', '--users'):
+                users_list = [int(n) for n in a.split(',')]
+            elif o in ('-n', '--hosts'):
+                hosts_list = [int(n) for n in a.split(',')]
+            elif o in ('-s', '--services'):
+                services = int(a)
+            elif o in ('-x', '--jitter'):
+                jitter = float(a)
+            else:
+                die('Unhandled command line option: {0}'.format(o))
+    except ValueError as err:
+        die('Invalid value: {0}'.format(err))
+
+    try:
+        main(hosts_list, users_list, services, latency, jitter, jobs, drift)
+    except KeyboardInterrupt:
+        die('Exiting on user request', 3)
+    sys.exit(0)
@@ -13,9 +13,13 @@ __status__ = "Beta"
 
 # Import python libs
 import getopt
+import json
+import math
 import os
 import sys
-from collections import namedtuple
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 # Import salt libs
 import salt.client.ssh.client
@@ -36,53 +40,115 @@ def usage():
         'Check users and groups configuration',
         'Copyright (C) 2017 Davide Madrisan <davide.madrisan.gmail.com>',
         'Usage:',
-        '\t' + progname + ' --user <user>[,<user2>,...] <hostame>',
+        '\t' + progname + ' --user <user>[,<user2>,...] [--jobs <N>]'
+            ' [--file <hostfile>] [<hostame>[,<hostname2>,...]]',
+        '\t\t[--profile] [--profile-log <file>]',
         '\t' + progname + ' -h',
-        'Example:\n' + '\tsudo %s -u hyperic frsopslapp052' % progname ]:
+        'Example:\n' + '\tsudo %s -u hyperic frsopslapp052' % progname,
+        '\tsudo %s -u hyperic -j 10 -f farm.txt' % progname ]:
         print(line)
 
+# the remote calls recorded when --profile is given (None: disabled)
+profile_calls = None
+profile_lock = threading.Lock()
+
+def record_call(target, modulename, start, json_out, state):
+    '''
+    Record the wall time, the size of the returned data and the final
+    state ('ok', 'error', 'exception') of a remote call
+    '''
+    if profile_calls is None:
+        return
+    try:
+        size = len(json.dumps(json_out))
+    except (TypeError, ValueError):
+        size = 0
+    call = dict(
+        target = target,
+        module = modulename,
+        start = start,
+        elapsed = time.time() - start,
+        bytes = size,
+        state = state)
+    with profile_lock:
+        profile_calls.append(call)
+
+def print_profile(calls, logfile=None):
+    '''
+    Print the number of calls and the p50/p95/max wall time and size of
+    the remote calls per host and per module, and optionally write every
+    call as a JSON line in 'logfile'
+    '''
+    def percentile(values, pct):
+        # nearest-rank method on sorted values
+        return values[max(0, int(math.ceil(pct * len(values) / 100.0)) - 1)]
+
+    for group in ('target', 'module'):
+        print('*** Remote calls per {0}'.format(group))
+        print('{0:<30} {1:>5} {2:>6} {3:>8} {4:>8} {5:>8} {6:>10}'.format(
+            group, 'calls', 'errors', 'p50 (s)', 'p95 (s)', 'max (s)',
+            'max bytes'))
+        calls_per_key = dict()
+        for call in calls:
+            calls_per_key.setdefault(call[group], []).append(call)
+        for key in sorted(calls_per_key):
+            elapsed = sorted(call['elapsed'] for call in calls_per_key[key])
+            print('{0:<30} {1:>5} {2:>6} {3:>8.3f} {4:>8.3f} {5:>8.3f} '
+                  '{6:>10}'.format(key, len(elapsed),
+                len([call for call in calls_per_key[key]
+                    if call['state'] != 'ok']),
+                percentile(elapsed, 50), percentile(elapsed, 95), elapsed[-1],
+                max(call['bytes'] for call in calls_per_key[key])))
+
+    if logfile:
+        try:
+            with open(logfile, 'a') as fp_:
+                for call in calls:
+                    fp_.write(json.dumps(call, sort_keys=True) + '\n')
+        except (IOError, OSError) as err:
+            die('cannot write {0}: {1}'.format(logfile, err))
+
 def saltstack_module_run(ssh_client, target, modulename, params=None):
     '''
     Return the 'return' entry of the dict returned by SaltStack
     '''
     saltstack_get_obj = lambda data, obj: data.get(target, {}).get(obj, {})
-    json_out = (
-        ssh_client.cmd(target, modulename, params) if params
-            else ssh_client.cmd(target, modulename))
-    errmsg = saltstack_get_obj(json_out, 'stderr')
-    outmsg = saltstack_get_obj(json_out, 'stdout')
+    start, json_out, state = time.time(), {}, 'exception'
+    try:
+        json_out = (
+            ssh_client.cmd(target, modulename, params) if params
+                else ssh_client.cmd(target, modulename))
+        errmsg = saltstack_get_obj(json_out, 'stderr')
+        outmsg = saltstack_get_obj(json_out, 'stdout')
+        state = 'error' if errmsg else 'ok'
+    finally:
+        record_call(target, modulename, start, json_out, state)
     if errmsg:
-        die('probably a BUG...\n{0} {1}'.format(errmsg, outmsg))
+        raise CommandExecutionError(
+            'probably a BUG...\n{0} {1}'.format(errmsg, outmsg))
 
     return saltstack_get_obj(json_out, 'return')
 
 def get_users_infos(ssh_client, target, users):
     '''
     Return a dictionary containing the system informations for
-    the list of users 'users'.
+    the list of users 'users' and their raw line in /etc/passwd.
+    A single remote execution is done whatever the number of users.
+    The users not found on 'target' are not reported.
     '''
-    all_groups = saltstack_module_run(
-        ssh_client, target, 'account.get_group_list')
-    group_names = all_groups.keys()
+    audit = saltstack_module_run(
+        ssh_client, target, 'account.audit_users', [','.join(users)])
 
     def _pack_data(user):
-        data = saltstack_module_run(
-            ssh_client, target, 'user.info', [user])
-        if not data:
-            raise CommandExecutionError(
-                'Unable to find the user: {0}'.format(user))
-        gid = data['gid']
-        groups = [grp for grp in group_names if all_groups[grp]['gid'] == gid]
-        secgroups = [grp for grp in data['groups'] if grp not in groups]
-
-        return dict(
-            group = ','.join(groups),
+        data = audit[user]
+        return (dict(
+            group = data['group'],
             shell = data['shell'],
             home = data['home'],
-            secgroups = ','.join(secgroups),
-        )
+            secgroups = ','.join(data['secgroups']),
+        ), data['raw'])
 
-    return dict((user, _pack_data(user)) for user in users)
+    return dict((user, _pack_data(user)) for user in users if user in audit)
 
 def print_user_info(user, data, raw):
     '''
@@ -96,7 +162,7 @@ def print_user_info(user, data, raw):
                home: /home/oracle
           secgroups: asmdba,dba,oper,sysbackup
               shell: /bin/bash
-           raw line: oracle:500:501::/home/oracle:/bin/bash
+           raw line: oracle:x:500:501::/home/oracle:/bin/bash
     '''
     print('[user {0}]'.format(user))
     items = sorted(data.keys())
@@ -104,44 +170,120 @@ def print_user_info(user, data, raw):
         print('{0:>15}: {1}'.format(item, data.get(item)))
     print('{0:>15}: {1}'.format('raw line', raw))
 
-def get_passwd_data(ssh_client, target):
+def check_host(target, users):
     '''
-    Return a dictionary containing the data found in the file /etc/passwd.
-    (key = username, value = the raw line of the corresponding user)
+    Collect the informations of 'users' on the host 'target'.
+    Return a tuple (target, infos, error message, elapsed time)
     '''
-    tokens = ('username', 'passwd', 'uid', 'gid', 'gecos', 'homedir', 'shell')
-    User = namedtuple('User', tokens)
+    start = time.time()
     try:
-        passwd_raw = saltstack_module_run(
-            ssh_client, target, 'account.get_passwd_raw')
-        user_infos = list(User(*line.rstrip().split(':'))
-            for line in passwd_raw)
-    except:
-        raise CommandExecutionError(
-            'An error has occurred while reading {0}'.format(filename)
-        )
-    def _pack_data(user):
-        return '{0}:{1}:{2}:{3}:{4}:{5}'.format(
-            user.username,
-            user.uid,
-            user.gid,
-            user.gecos,
-            user.homedir,
-            user.shell)
-    return dict((user.username, _pack_data(user)) for user in user_infos)
-
-def main(target, users):
-    ssh_client = salt.client.ssh.client.SSHClient()
-    out = get_users_infos(ssh_client, target, users)
-    passwd = get_passwd_data(ssh_client, target)
+        ssh_client = salt.client.ssh.client.SSHClient()
+        out = get_users_infos(ssh_client, target, users)
+        return (target, out, None, time.time() - start)
+    except Exception as err:
+        return (target, None, str(err), time.time() - start)
+
+def print_host_report(users, out):
+    for user in users:
+        if user not in out:
+            print('[user {0}]\n{1:>15}: {2}'.format(
+                user, 'error', 'user not found'))
+            continue
+        data, raw = out.get(user)
+        print_user_info(user, data, raw)
+
+def print_user_matrix(users, results):
+    '''
+    Print, for each user, the attributes having different values
+    across the hosts
+
+    Example of output:
+
+        [user oracle]
+              shell: /bin/bash: host01,host02
+                     /bin/ksh: host03
+        [user grid]
+                 OK: identical on 3 hosts
+    '''
+    missing = '<not found>'
     for user in users:
-        print_user_info(user, out.get(user), passwd.get(user))
+        print('[user {0}]'.format(user))
+        disagreements = 0
+        for item in ('group', 'secgroups', 'shell', 'home'):
+            hosts_per_value = dict()
+            for target in sorted(results):
+                data = results[target].get(user, (None, None))[0]
+                value = data.get(item) if data else missing
+                hosts_per_value.setdefault(value, []).append(target)
+            if len(hosts_per_value) < 2:
+                continue
+            disagreements += 1
+            separator = ':'
+            for value in sorted(hosts_per_value):
+                print('{0:>15}{1} {2}: {3}'.format(item, separator,
+                    value or '-', ','.join(hosts_per_value[value])))
+                item, separator = '', ' '
+        if disagreements:
+            continue
+        if all(user not in out for out in results.values()):
+            print('{0:>15}: user not found on {1} hosts'.format(
+                'error', len(results)))
+        else:
+            print('{0:>15}: identical on {1} hosts'.format(
+                'OK', len(results)))
+
+def main(targets, users, jobs=1):
+    if len(targets) == 1:
+        target, out, error, _ = check_host(targets[0], users)
+        if error:
+            die(error)
+        print_host_report(users, out)
+        return 0
+
+    results, failures = dict(), 0
+    start = time.time()
+    pool = ThreadPool(max(1, min(jobs, len(targets))))
+    try:
+        # print the reports as soon as each host completes
+        for target, out, error, elapsed in pool.imap_unordered(
+                lambda target: check_host(target, users), targets):
+            print('*** {0} ({1:.2f}s)'.format(target, elapsed))
+            if error:
+                failures += 1
+                print('{0:>15}: {1}'.format('error', error))
+                continue
+            results[target] = out
+            print_host_report(users, out)
+    finally:
+        pool.close()
+        pool.join()
+
+    print('*** Differences between {0} hosts ({1:.2f}s)'.format(
+        len(results), time.time() - start))
+    print_user_matrix(users, results)
+    return 1 if failures else 0
+
+def read_targets(filename):
+    '''
+    Return the hostnames listed in 'filename' (one or more per line,
+    comma or space separated, '#' starts a comment)
+    '''
+    targets = []
+    try:
+        with salt.utils.fopen(filename, 'r') as fp_:
+            for line in fp_:
+                line = line.split('#', 1)[0]
+                targets.extend(line.replace(',', ' ').split())
+    except (IOError, OSError) as err:
+        die('cannot read {0}: {1}'.format(filename, err))
+    return targets
 
 if __name__ == '__main__':
-    hostname, users = (None, None)
+    profile_log = None
+    users, jobs, targets = None, 8, []
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'u:h',
-            ["user=", "help"])
+        opts, args = getopt.getopt(sys.argv[1:], 'f:hj:pu:',
+            ["file=", "help", "jobs=", "profile", "profile-log=", "user="])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -150,18 +292,36 @@ if __name__ == '__main__':
         if o in ('-h', '--help'):
             usage()
             sys.exit()
+        elif o in ('-f', '--file'):
+            targets.extend(read_targets(a))
+        elif o in ('-j', '--jobs'):
+            try:
+                jobs = int(a)
+            except ValueError:
+                die('Invalid number of jobs: {0}'.format(a))
         elif o in ('-u', '--user'):
             users = a.strip().split(',')
+        elif o in ('-p', '--profile'):
+            profile_calls = []
+        elif o == '--profile-log':
+            profile_calls, profile_log = [], a
         else:
             die('Unhandled command line option: {0}'.format(o))
 
-    if not users or len(args) != 1: usage(); sys.exit(2)
+    for arg in args:
+        targets.extend(host for host in arg.strip().split(',') if host)
+    # remove the duplicate hosts but keep the command line order
+    targets = sorted(set(targets), key=targets.index)
+
+    if not users or not targets: usage(); sys.exit(2)
     if os.geteuid() != 0:
         die('This script must be run as root')
 
-    target = args[0]
     try:
-        main(target, users)
+        exitcode = main(targets, users, jobs)
     except KeyboardInterrupt:
         die(3, 'Exiting on user request')
-    sys.exit(0)
+    finally:
+        if profile_calls is not None:
+            print_profile(profile_calls, profile_log)
+    sys.exit(exitcode)
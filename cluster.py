@@ -7,10 +7,26 @@ Copyright (C) 2017 Davide Madrisan <davide.madrisan.gmail.com>
 '''
 
 # Import python libs
+import os
 from os.path import basename as basename
 
 __virtualname__ = 'cluster'
 
+# the daemons identifying each cluster technology (rgmanager and
+# pacemaker never run together on a node)
+cluster_daemons = (
+    ('clurgmgrd', 'Red Hat Cluster Suite'),
+    ('pacemakerd', 'Pacemaker Cluster'),
+)
+
+# pid files possibly written by the cluster daemons
+cluster_pidfiles = (
+    ('/var/run/rgmanager.pid', 'clurgmgrd'),
+    ('/var/run/clurgmgrd.pid', 'clurgmgrd'),
+    ('/var/run/pacemakerd.pid', 'pacemakerd'),
+    ('/run/pacemakerd.pid', 'pacemakerd'),
+)
+
 def __virtual__():
     '''
     Confine this execution module on Red Hat systems
@@ -19,31 +35,78 @@ def __virtual__():
         return (False, 'Unsopported os.')
     return True
 
-def is_active():
+def _proc_comm(pid):
     '''
-    Check if a system cluster is running on this node.
-
-    CLI Example:
+    Return the command name of the process 'pid', or None.
+    /proc/<pid>/stat is used on the kernels without /proc/<pid>/comm.
+    '''
+    try:
+        with open('/proc/{0}/comm'.format(pid), 'r') as fp_:
+            return fp_.read().strip()
+    except (IOError, OSError):
+        pass
+    try:
+        with open('/proc/{0}/stat'.format(pid), 'r') as fp_:
+            stat = fp_.read()
+        return stat[stat.index('(') + 1:stat.rindex(')')]
+    except (IOError, OSError, ValueError):
+        return None
 
-        .. code-block:: bash
+def _running_daemon():
+    '''
+    Return the name of the cluster daemon running.  The known pid files
+    are checked first, then /proc/*/comm is scanned, stopping at the first
+    cluster daemon found.
+    Return '' when no daemon is running, or None when /proc cannot be read.
+    '''
+    for pidfile, daemon in cluster_pidfiles:
+        try:
+            with open(pidfile, 'r') as fp_:
+                pid = fp_.read().strip()
+        except (IOError, OSError):
+            continue
+        if pid.isdigit() and _proc_comm(pid) == daemon:
+            return daemon
 
-            salt '*' cluster.is_active
+    daemons = dict(cluster_daemons)
+    try:
+        pids = [entry for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return None
+    for pid in pids:
+        comm = _proc_comm(pid)
+        if comm in daemons:
+            return comm
+    return ''
 
+def _procs_daemons():
+    '''
+    Return the list of the commands running on this node, by using the
+    full process table provided by status.procs
     '''
     first = lambda x: x.split()[0]
     cmd = lambda infos: first(infos.get('cmd'))
     kernel_proc = lambda c: c.startswith('[')
     procs_info = __salt__['status.procs']()
-    procs_cmds = list(basename(cmd(p))
+    return list(basename(cmd(p))
         for p in procs_info.values() if not kernel_proc(cmd(p)))
 
-    rh_cluster_suite = lambda procs: 'clurgmgrd' in procs
-    pacemaker_cluster = lambda procs: 'pacemakerd' in procs
+def is_active():
+    '''
+    Check if a system cluster is running on this node.
 
-    if rh_cluster_suite(procs_cmds):
-        return (True, 'Red Hat Cluster Suite')
-    elif pacemaker_cluster (procs_cmds):
-        return (True, 'Pacemaker Cluster')
+    CLI Example:
 
-    return (False, 'Not a cluster node')
+        .. code-block:: bash
 
+            salt '*' cluster.is_active
+
+    '''
+    daemon = _running_daemon()
+    procs_cmds = [daemon] if daemon is not None else _procs_daemons()
+
+    for daemon, technology in cluster_daemons:
+        if daemon in procs_cmds:
+            return (True, technology)
+
+    return (False, 'Not a cluster node')
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+'''
+SaltStack code snippets.
+Module for running several checks in a single remote execution.
+Copyright (C) 2017 Davide Madrisan <davide.madrisan.gmail.com>
+'''
+# Import python libs
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
+
+# Define the module's virtual name
+__virtualname__ = 'cluster_check'
+
+# the number of functions run at the same time by collect(parallel=True)
+parallel_threads = 4
+
+def _as_list(items):
+    '''
+    Accept both a python list and a comma separated string (CLI usage)
+    '''
+    if hasattr(items, 'split'):
+        return [item for item in items.split(',') if item]
+    return list(items or [])
+
+def _as_dict(items):
+    '''
+    Accept both a python dictionary and its JSON representation: salt-ssh
+    passes the keyword arguments to the remote side as key=value strings
+    '''
+    if hasattr(items, 'split'):
+        return json.loads(items)
+    return dict(items or {})
+
+def _run(fun):
+    '''
+    Run the execution module function 'fun' and return a dictionary
+    containing either its return value or the error message
+    '''
+    if fun not in __salt__:
+        return {'error': "'{0}' is not available".format(fun)}
+    try:
+        return {'return': __salt__[fun]()}
+    except Exception as err:
+        return {'error': str(err) or err.__class__.__name__}
+
+def _digest_record(record):
+    '''
+    Return the sha1 digest of the normalized (JSON, sorted keys)
+    representation of 'record'
+    '''
+    normalized = json.dumps(record, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+def _digest_table(table):
+    '''
+    Return the digest of each entry of the dictionary 'table' and the
+    root digest of the whole table, computed over the sorted entry
+    digests, so that two identical tables have the same root
+    '''
+    entries = dict((key, _digest_record(record))
+        for key, record in table.items())
+    root = hashlib.sha1()
+    for key in sorted(entries):
+        root.update(u'{0}\0{1}\n'.format(key, entries[key]).encode('utf-8'))
+    return {'root': root.hexdigest(), 'entries': entries}
+
+def _collect_one(fun, digest=False, known=None):
+    '''
+    Run the function 'fun' and, if 'digest' is True, replace its return
+    value by the digests of the returned dictionary ('known' being the
+    root digest already known by the caller)
+    '''
+    data = _run(fun)
+    if not digest or 'return' not in data:
+        return data
+    if not isinstance(data['return'], dict):
+        return {'error': "'{0}' did not return a dictionary".format(fun)}
+    try:
+        table = _digest_table(data['return'])
+    except Exception as err:
+        return {'error': str(err) or err.__class__.__name__}
+    if known == table['root']:
+        table = {'root': table['root'], 'unchanged': True}
+    return {'return': table}
+
+def collect(*funs, **kwargs):
+    '''
+    Run the execution module functions 'funs' (without arguments) in this
+    minion process and return one dictionary containing, for each function,
+    its return value (key 'return') or the error message (key 'error').
+
+    The optional keyword argument 'grains' is a comma separated list of
+    grains: only these grains are returned, in the 'grains' key.
+
+    The optional keyword argument 'digest' is a comma separated list of
+    functions, among 'funs', returning a dictionary: for these functions
+    only the digest of each entry and the root digest of the whole
+    dictionary are returned (see cluster_check.fetch).
+
+    The optional keyword argument 'known' maps some of these functions
+    to the root digest already known by the caller: when the root digest
+    has not changed, the entry digests are not returned and the key
+    'unchanged' is set.
+
+    When the optional keyword argument 'parallel' is True (or a number of
+    threads), the functions are run concurrently by a bounded pool of
+    threads, started in the given order: the most expensive functions
+    should be given first.
+
+    CLI Example:
+
+        .. code-block:: bash
+
+            salt '*' cluster_check.collect cluster.is_active account.get_user_list
+            salt '*' cluster_check.collect cluster.is_active grains=osarch,osrelease
+            salt '*' cluster_check.collect account.get_user_list digest=account.get_user_list
+    '''
+    digests = set(_as_list(kwargs.get('digest')))
+    known = kwargs.get('known') or {}
+    run = lambda fun: _collect_one(fun, fun in digests, known.get(fun))
+
+    threads = kwargs.get('parallel')
+    threads = parallel_threads if threads is True else int(threads or 1)
+    if threads > 1 and len(funs) > 1:
+        pool = ThreadPool(min(threads, len(funs)))
+        try:
+            ret = dict(zip(funs, pool.map(run, funs, chunksize=1)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        ret = dict((fun, run(fun)) for fun in funs)
+    grains = kwargs.get('grains')
+    if grains:
+        ret['grains'] = dict(
+            (grain, __grains__.get(grain)) for grain in _as_list(grains))
+    return ret
+
+def fetch(tables):
+    '''
+    Return the full content of some entries only of the dictionaries
+    returned by a set of functions.  'tables' maps each function to the
+    list of the keys to be returned, and can also be given as a JSON
+    string.  Missing keys are not reported.
+
+    CLI Example:
+
+        .. code-block:: bash
+
+            salt '*' cluster_check.fetch tables='{"account.get_user_list": ["root", "bin"]}'
+    '''
+    def _pack_data(fun, keys):
+        data = _run(fun)
+        if 'return' in data:
+            table = data['return']
+            if not isinstance(table, dict):
+                return {'error': "'{0}' did not return a dictionary".format(
+                    fun)}
+            data['return'] = dict(
+                (key, table[key]) for key in _as_list(keys) if key in table)
+        return data
+    return dict((fun, _pack_data(fun, keys))
+        for fun, keys in _as_dict(tables).items())
@@ -8,24 +8,244 @@ Copyright (C) 2017 Davide Madrisan <davide.madrisan.gmail.com>
 '''
 
 # Import 3rd-party libs
+import json
+import logging
 import os
+import tempfile
+import time
 
 # Import salt libs
 import salt.utils
 import salt.utils.fsutils
 from salt.exceptions import CommandExecutionError
 
+log = logging.getLogger(__name__)
+
 __virtualname__ = 'cpuinfo'
 proc_cpuinfo = '/proc/cpuinfo'
+proc_stat = '/proc/stat'
+proc_interrupts = '/proc/interrupts'
+sysfs_cpu = '/sys/devices/system/cpu'
+sysfs_node = '/sys/devices/system/node'
+
+# the CPU topology is static: it is read once per minion process
+_topology = None
+
+# the file of the minion cache directory holding the last /proc/stat
+# sample, used by utilization(interval=0): the minion runs each job in a
+# new process, so a module global would not survive between the calls
+stat_sample_file = 'cpuinfo_stat_sample.json'
+
+# /proc/stat fields: user nice system idle iowait irq softirq steal
+# (guest and guest_nice are already accounted in user and nice)
+_stat_fields = 8
 
 def __virtual__():
     if not os.path.exists(proc_cpuinfo):
         return (False, 'The {0} file cannot be found.'.format(proc_cpuinfo))
     return True
 
+def _read_sysfs(path):
+    try:
+        with salt.utils.fopen(path, 'r') as fp_:
+            return fp_.read().strip()
+    except (IOError, OSError):
+        return None
+
+def _parse_cpulist(cpulist):
+    '''
+    Expand a sysfs CPU list ('0-3,8,10-11') to a list of integers
+    '''
+    cpus = []
+    for chunk in (cpulist or '').split(','):
+        if '-' in chunk:
+            first, last = chunk.split('-', 1)
+            cpus.extend(range(int(first), int(last) + 1))
+        elif chunk:
+            cpus.append(int(chunk))
+    return cpus
+
+def _sysfs_topology():
+    '''
+    Return the CPU topology read from /sys/devices/system/{cpu,node},
+    or None when sysfs does not provide it
+    '''
+    online = _parse_cpulist(_read_sysfs(os.path.join(sysfs_cpu, 'online')))
+    if not online:
+        return None
+
+    packages, cores, caches = set(), set(), dict()
+    for cpu in online:
+        cpudir = os.path.join(sysfs_cpu, 'cpu{0}'.format(cpu))
+        package = _read_sysfs(
+            os.path.join(cpudir, 'topology', 'physical_package_id'))
+        core = _read_sysfs(os.path.join(cpudir, 'topology', 'core_id'))
+        if package is None or core is None:
+            return None
+        packages.add(package)
+        cores.add((package, core))
+
+        cachedir = os.path.join(cpudir, 'cache')
+        for index in (os.listdir(cachedir) if os.path.isdir(cachedir) else []):
+            read = lambda attr: _read_sysfs(os.path.join(cachedir, index, attr))
+            level, cachetype = read('level'), read('type')
+            if not level or not cachetype:
+                continue
+            name = 'L{0}{1}'.format(level, {
+                'Data': 'd', 'Instruction': 'i'}.get(cachetype, ''))
+            cache = caches.setdefault(
+                name, {'size': read('size'), 'shared_cpu_lists': set()})
+            cache['shared_cpu_lists'].add(read('shared_cpu_list'))
+
+    numa_nodes = dict()
+    if os.path.isdir(sysfs_node):
+        for node in os.listdir(sysfs_node):
+            if node.startswith('node') and node[4:].isdigit():
+                numa_nodes[node] = _read_sysfs(
+                    os.path.join(sysfs_node, node, 'cpulist'))
+
+    sockets = len(packages)
+    return {
+        'logicals': len(online),
+        'sockets': sockets,
+        'cores': len(cores),
+        'cores_per_socket': len(cores) // sockets,
+        'threads_per_core': len(online) // len(cores),
+        'numa_nodes': len(numa_nodes) or 1,
+        'numa': numa_nodes,
+        'caches': dict((name, {
+            'size': cache['size'],
+            'instances': len(cache['shared_cpu_lists'])
+        }) for name, cache in caches.items()),
+    }
+
+def _sysfs():
+    '''
+    Return the number of logical CPUs, sockets and cores per socket
+    from the (cached) sysfs topology
+    '''
+    infos = topology()
+    if not infos:
+        return None
+    return (infos['logicals'], infos['sockets'], infos['cores_per_socket'])
+
+def _read_proc_stat():
+    '''
+    Return the cumulative CPU times found in /proc/stat, as a dictionary
+    (key = 'cpu' for the total or 'cpuN', value = list of jiffies)
+    '''
+    try:
+        with salt.utils.fopen(proc_stat, 'r') as fp_:
+            content = fp_.read()
+    except (IOError, OSError):
+        raise CommandExecutionError(
+            'An error has occurred while reading {0}'.format(proc_stat)
+        )
+    times = dict()
+    for line in content.splitlines():
+        if not line.startswith('cpu'):
+            break
+        fields = line.split()
+        times[fields[0]] = [int(value) for value in fields[1:_stat_fields + 1]]
+    return times
+
+def _sample_path(filename):
+    '''
+    Return the path of 'filename' in the minion cache directory
+    '''
+    opts = globals().get('__opts__', {})
+    return os.path.join(
+        opts.get('cachedir', '/var/cache/salt/minion'), filename)
+
+def _load_sample(filename):
+    '''
+    Return the sample saved in the minion cache directory, or None
+    '''
+    try:
+        with salt.utils.fopen(_sample_path(filename), 'r') as fp_:
+            return json.load(fp_)
+    except (IOError, OSError, ValueError):
+        return None
+
+def _save_sample(filename, sample):
+    '''
+    Save 'sample' in the minion cache directory.  A temporary file is
+    renamed, so that a concurrent call never reads a partial sample.
+    '''
+    path = _sample_path(filename)
+    try:
+        fd, tmpfile = tempfile.mkstemp(
+            prefix='.' + filename + '.', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w') as fp_:
+                json.dump(sample, fp_)
+            os.rename(tmpfile, path)
+        except (IOError, OSError):
+            os.unlink(tmpfile)
+            raise
+    except (IOError, OSError) as err:
+        log.debug('Cannot write {0}: {1}'.format(path, err))
+
+def _cpu_percentages(previous, current):
+    '''
+    Return the user/system/iowait/steal/idle percentages of the CPU time
+    spent between the samples 'previous' and 'current'
+    '''
+    previous = previous or [0] * len(current)
+    delta = [cur - prev for cur, prev in zip(current, previous)]
+    delta.extend([0] * (_stat_fields - len(delta)))
+    user, nice, system, idle, iowait, irq, softirq, steal = delta
+    total = float(sum(delta)) or 1.0
+    percent = lambda value: round(100 * value / total, 2)
+    return {
+        'user': percent(user + nice),
+        'system': percent(system + irq + softirq),
+        'iowait': percent(iowait),
+        'steal': percent(steal),
+        'idle': percent(idle),
+    }
+
+def _read_proc_interrupts():
+    '''
+    Return the CPU names and the /proc/interrupts counters as a dictionary
+    (key = IRQ, value = (list of per-CPU counters, device description))
+    '''
+    try:
+        with salt.utils.fopen(proc_interrupts, 'r') as fp_:
+            lines = fp_.read().splitlines()
+    except (IOError, OSError):
+        raise CommandExecutionError(
+            'An error has occurred while reading {0}'.format(proc_interrupts)
+        )
+    cpus = lines[0].split() if lines else []
+    ncpus = len(cpus)
+
+    counters = dict()
+    for line in lines[1:]:
+        # a single split, bounded by the number of CPU columns
+        fields = line.split(None, ncpus + 1)
+        if len(fields) < 2:
+            continue
+        irq = fields[0].rstrip(':')
+        try:
+            counts = list(map(int, fields[1:ncpus + 1]))
+            device = fields[ncpus + 1] if len(fields) > ncpus + 1 else ''
+        except ValueError:
+            # rows like ERR and MIS only have one counter
+            counts = []
+            for field in fields[1:]:
+                if not field.isdigit():
+                    break
+                counts.append(int(field))
+            device = ' '.join(fields[len(counts) + 1:])
+        counts.extend([0] * (ncpus - len(counts)))
+        counters[irq] = (counts, ' '.join(device.split()))
+    return (cpus, counters)
+
 def _lscpu():
     '''
-    Get available CPU information.
+    Get available CPU information from the lscpu command, as integers,
+    or None when it is not available.
     '''
     try:
         out = __salt__['cmd.run_all']("lscpu")
@@ -36,25 +256,32 @@ def _lscpu():
     for descr, value in [elm.split(":", 1) for elm in out['stdout'].split(os.linesep)]:
         data[descr.strip()] = value.strip()
 
-    cpus = data.get('CPU(s)')
-    sockets = data.get('Socket(s)')
-    cores = data.get('Core(s) per socket')
+    try:
+        cpus = int(data['CPU(s)'])
+        sockets = int(data['Socket(s)'])
+        cores = int(data['Core(s) per socket'])
+    except (KeyError, ValueError):
+        return None
 
     return (cpus, sockets, cores)
 
 def _proc():
     cpus, cpu_core_id, cpu_physical_id = 0, set(), set()
+    physical_id = None
 
     with salt.utils.fopen(proc_cpuinfo, 'r') as fp_:
         for line in fp_:
             if line.startswith('processor'):
                 cpus += 1
             elif line.startswith('core id'):
-                cpu_core_id.update([line.split(':')[1].strip()])
+                # the core ids are only unique inside a socket
+                cpu_core_id.update(
+                    [(physical_id, line.split(':')[1].strip())])
             elif line.startswith('physical id'):
-                cpu_physical_id.update([line.split(':')[1].strip()])
-        cores = len(cpu_core_id)
+                physical_id = line.split(':')[1].strip()
+                cpu_physical_id.update([physical_id])
         sockets = len(cpu_physical_id)
+        cores = len(cpu_core_id) // max(sockets, 1)
 
     if cores == 0 and sockets == 0:
         # FIXME: assume that one core is installed
@@ -65,9 +292,9 @@ def _proc():
 
 def lscpu(*args):
     '''
-    Return the number of core, logical, and CPU sockets, by parsing
-    the lscpu command and following back to /proc/cpuinfo when this tool
-    is not available.
+    Return the number of core (per socket), logical, and CPU sockets,
+    by reading the sysfs CPU topology, and following back to the lscpu
+    command and then to /proc/cpuinfo when sysfs is not available.
 
     CLI Example:
 
@@ -76,7 +303,7 @@ def lscpu(*args):
             salt '*' cpuinfo.lscpu
             salt '*' cpuinfo.lscpu logicals
     '''
-    (cpus, sockets, cores) = _lscpu() or _proc()
+    (cpus, sockets, cores) = _sysfs() or _lscpu() or _proc()
 
     infos = {
         'cores': cores,
@@ -94,3 +321,133 @@ def lscpu(*args):
             'Invalid flag passed to {0}.proc'.format(__virtualname__)
         )
     return ret
+
+def topology():
+    '''
+    Return the CPU topology (sockets, cores, threads, NUMA nodes and
+    caches) read from sysfs.  The topology is read once and then kept
+    for the whole life of the minion process.
+
+    CLI Example:
+
+        .. code-block:: bash
+
+            salt '*' cpuinfo.topology
+    '''
+    global _topology
+    if _topology is None:
+        _topology = _sysfs_topology() or {}
+    return _topology
+
+def utilization(interval=1, per_cpu=False):
+    '''
+    Return the percentage of CPU time spent in user, system, iowait,
+    steal and idle mode during 'interval' seconds, computed from two
+    /proc/stat samples.  Set 'per_cpu' to also get the values of each
+    logical CPU.
+
+    With interval=0 the call does not sleep and returns the utilization
+    since the previous call made on this minion, whose sample is kept in
+    the minion cache directory ('since' is then 'previous call'), or
+    since boot for the first call ('since' is then 'boot').
+
+    CLI Example:
+
+        .. code-block:: bash
+
+            salt '*' cpuinfo.utilization
+            salt '*' cpuinfo.utilization interval=5 per_cpu=True
+            salt '*' cpuinfo.utilization interval=0
+    '''
+    try:
+        interval = float(interval)
+    except (TypeError, ValueError):
+        raise CommandExecutionError(
+            'Invalid interval passed to {0}.utilization: {1}'.format(
+                __virtualname__, interval)
+        )
+
+    if interval > 0:
+        previous = _read_proc_stat()
+        time.sleep(interval)
+    else:
+        previous = _load_sample(stat_sample_file) or dict()
+    current = _read_proc_stat()
+    _save_sample(stat_sample_file, current)
+    if sum(previous.get('cpu', [])) > sum(current['cpu']):
+        # the sample has been taken before a reboot
+        previous = dict()
+
+    ret = _cpu_percentages(previous.get('cpu', []), current['cpu'])
+    if interval <= 0:
+        ret['since'] = 'previous call' if previous else 'boot'
+    if per_cpu:
+        ret['cpus'] = dict(
+            (cpu, _cpu_percentages(previous.get(cpu, []), times))
+            for cpu, times in current.items() if cpu != 'cpu')
+    return ret
+
+def interrupts(interval=1, threshold=90, min_rate=1):
+    '''
+    Return the interrupt rates (per second) of each IRQ and each CPU,
+    computed from two /proc/interrupts samples taken 'interval' seconds
+    apart (with interval=0, the counters since boot are reported).
+
+    The device IRQs firing at least 'min_rate' times per second and
+    having at least 'threshold' percent of their load on a single CPU
+    are listed in 'concentrated'.
+
+    CLI Example:
+
+        .. code-block:: bash
+
+            salt '*' cpuinfo.interrupts
+            salt '*' cpuinfo.interrupts interval=5 threshold=80
+    '''
+    try:
+        interval, threshold, min_rate = (
+            float(interval), float(threshold), float(min_rate))
+    except (TypeError, ValueError):
+        raise CommandExecutionError(
+            'Invalid argument passed to {0}.interrupts'.format(__virtualname__)
+        )
+
+    previous = None
+    if interval > 0:
+        previous = _read_proc_interrupts()[1]
+        time.sleep(interval)
+    cpus, current = _read_proc_interrupts()
+
+    irqs, cpu_rates, concentrated = dict(), [0.0] * len(cpus), []
+    for irq, (counts, device) in current.items():
+        if previous and irq in previous:
+            counts = [cur - prev for cur, prev in zip(counts, previous[irq][0])]
+        rates = [count / interval for count in counts] if interval > 0 \
+            else counts
+        total = sum(rates)
+        if not total:
+            continue
+        for cpu, rate in enumerate(rates):
+            cpu_rates[cpu] += rate
+
+        top = max(range(len(rates)), key=rates.__getitem__)
+        share = round(100.0 * rates[top] / total, 2)
+        irqs[irq] = {
+            'device': device,
+            'rate': round(total, 2),
+            'top_cpu': cpus[top],
+            'top_cpu_share': share,
+            'cpus': dict((cpus[cpu], round(rate, 2))
+                for cpu, rate in enumerate(rates) if rate),
+        }
+        if (irq.isdigit() and len(cpus) > 1 and total >= min_rate
+                and share >= threshold):
+            concentrated.append(irq)
+
+    return {
+        'interval': interval,
+        'irqs': irqs,
+        'cpus': dict((cpu, round(rate, 2))
+            for cpu, rate in zip(cpus, cpu_rates)),
+        'concentrated': sorted(concentrated, key=int),
+    }
@@ -7,14 +7,52 @@ Copyright (C) 2017 Davide Madrisan <davide.madrisan.gmail.com>
 # Import python libs
 from __future__ import division
 import collections
+import fcntl
 import logging
 import os
+import struct
+import threading
+import time
+
+# Import salt libs
+import salt.utils
+from salt.exceptions import CommandExecutionError
 
 log = logging.getLogger(__name__)
 
 # Define the module's virtual name
 __virtualname__ = 'fsinfo'
 
+fstab_file = '/etc/fstab'
+mountinfo_file = '/proc/self/mountinfo'
+diskstats_file = '/proc/diskstats'
+sysfs_block = '/sys/class/block'
+
+# we will ignore all the filesystem with a fstype not in this list
+fs_check_types = [
+    'autofs',
+    'ext2', 'ext3', 'ext4',
+    'nfs', 'nfs4',
+    'xfs' ]
+
+FileSystem = collections.namedtuple('Filesystem',
+    ('filesystem', 'fstype', 'blocks', 'used',
+     'available', 'capacity', 'mountpoint'))
+
+# capacity trend store: one ring buffer file per mountpoint, made of a
+# header holding the running sums of the linear regression followed by
+# fixed size records (time, used, available, inodes used, inodes available)
+_trend_magic = b'FSTR'
+_trend_header = struct.Struct('<4sIIId6d')
+_trend_record = struct.Struct('<dQQQQ')
+
+# the statvfs threads still blocked on a mountpoint by a previous call
+# (key = mountpoint, value = thread)
+_hung_statvfs = {}
+
+FstabEntry = collections.namedtuple('FstabEntry',
+    ('spec', 'mountpoint', 'fstype', 'options', 'dump', 'passno'))
+
 def _sizeof_fmt(tok, factor=1024.0, skip=1, suffix='B'):
     '''
     Divide 'num' to its best unit and append it to the output.
@@ -31,64 +69,242 @@ def _sizeof_fmt(tok, factor=1024.0, skip=1, suffix='B'):
         num /= factor
     return "%.1f%s%s" % (num, 'p', suffix)
 
-def _get_multipath_names():
+def _fstab_unescape(field):
+    '''
+    Decode the octal escapes (ex. '\\040' for a space) used in fstab fields
+    '''
+    if '\\' not in field:
+        return field
+    chunks = field.split('\\')
+    out = [chunks[0]]
+    for chunk in chunks[1:]:
+        code = chunk[:3]
+        if len(code) == 3 and all(c in '01234567' for c in code):
+            out.append(chr(int(code, 8)) + chunk[3:])
+        else:
+            out.append('\\' + chunk)
+    return ''.join(out)
+
+def _resolve_spec(spec):
+    '''
+    Return the device path the fstab 'spec' (UUID=, LABEL=, or path)
+    refers to, or None when it cannot be resolved
+    '''
+    for prefix, directory in (('UUID=', '/dev/disk/by-uuid'),
+                              ('LABEL=', '/dev/disk/by-label')):
+        if spec.startswith(prefix):
+            link = os.path.join(directory, spec[len(prefix):].strip('"'))
+            return os.path.realpath(link) if os.path.exists(link) else None
+    if spec.startswith('/dev/'):
+        return os.path.realpath(spec)
+    return None
+
+def _parse_fstab():
+    '''
+    Parse /etc/fstab in a single pass and return an index of its entries
+    (key = device spec as written and resolved device path,
+     value = FstabEntry)
+    '''
+    index = {}
     try:
-        cmd = 'multipath -l -v1'
-        out = __salt__['cmd.run'](cmd).splitlines()
-    except:
+        with salt.utils.fopen(fstab_file, 'r') as fp_:
+            lines = fp_.readlines()
+    except (IOError, OSError):
+        log.error('Error while reading {0}'.format(fstab_file))
+        return index
+
+    for line in lines:
+        fields = line.split('#', 1)[0].split()
+        if len(fields) < 2:
+            continue
+        fields = [_fstab_unescape(field) for field in fields[:6]]
+        fields.extend(['', '', 'auto', 'defaults', '0', '0'][len(fields):])
+        entry = FstabEntry(*fields)
+        index.setdefault(entry.spec, entry)
+        device = _resolve_spec(entry.spec)
+        if device:
+            index.setdefault(device, entry)
+    return index
+
+def _fstab_lookup(index, device):
+    '''
+    Return the fstab entry of the mounted 'device', or None
+    '''
+    entry = index.get(device)
+    if entry is None and device.startswith('/dev/'):
+        entry = index.get(os.path.realpath(device))
+    return entry
+
+def _sysfs_attr(*path):
+    try:
+        with salt.utils.fopen(os.path.join(sysfs_block, *path), 'r') as fp_:
+            return fp_.read().strip()
+    except (IOError, OSError):
         return None
-    return out
 
-def _get_lvm_infos(device):
-    vgname = {}
+def _dm_type(uuid):
+    '''
+    Return the kind of device-mapper device from its 'uuid'
+    (ex. mpath-3600508b..., LVM-<vg uuid><lv uuid>, part1-mpath-...)
+    '''
+    for prefix, dmtype in (('mpath-', 'multipath'), ('LVM-', 'lvm'),
+                           ('CRYPT-', 'crypt')):
+        if uuid.startswith(prefix):
+            return dmtype
+    if uuid.startswith('part') and '-' in uuid:
+        return 'partition'
+    return 'dm'
+
+def _dm_topology():
+    '''
+    Return the device-mapper topology read from sysfs in one pass
+    (key = dm-N, value = name, uuid, type, slaves, and the multipath
+    WWIDs and the sd paths found below the device)
+    '''
     try:
-        lvdisplay = __salt__['lvm.lvdisplay'](device)
-        if lvdisplay:
-            data = lvdisplay.get(*lvdisplay.keys())
-            vgname = data.get('Volume Group Name')
-            # NOTE: according to
-            # https://bugzilla.redhat.com/show_bug.cgi?id=190730
-            # the output is in 512byte sectors.
-            lvsize = data.get('Logical Volume Size')
-            return {
-                'vgname': vgname,
-                'lvsize': int(lvsize) // 2
-            }
-    except:
-        log.warning('Error while parsing lvm info for {0}'.format(device))
-    return {}
-
-def _get_physical_volume_device(vgname):
-    out = __salt__['lvm.pvdisplay']()
-    device_list = out.keys()
-    dev_mapper_list = list(
-        device for device in device_list
-            if out.get(device, {}).get('Volume Group Name', '') == vgname)
-    return dev_mapper_list[0] if len(dev_mapper_list) == 1 else dev_mapper_list
-
-def usage(human_readable=True):
+        dm_devices = [name for name in os.listdir(sysfs_block)
+            if name.startswith('dm-')]
+    except OSError:
+        return {}
+
+    topology = {}
+    for dev in dm_devices:
+        uuid = _sysfs_attr(dev, 'dm', 'uuid') or ''
+        name = _sysfs_attr(dev, 'dm', 'name') or ''
+        try:
+            slaves = sorted(os.listdir(os.path.join(sysfs_block, dev, 'slaves')))
+        except OSError:
+            slaves = []
+        infos = {
+            'name': name,
+            'uuid': uuid,
+            'type': _dm_type(uuid),
+            'slaves': slaves,
+        }
+        if infos['type'] == 'multipath':
+            infos['wwid'] = uuid[len('mpath-'):]
+        elif infos['type'] == 'lvm':
+            # the dashes in the VG and LV names are doubled in the dm name
+            parts = name.replace('--', '\0').split('-', 1)
+            infos['lvname'] = '/'.join(
+                part.replace('\0', '-') for part in parts)
+        topology[dev] = infos
+
+    path_states = {}
+    def below(dev, seen):
+        # return the multipath WWIDs and the sd paths below 'dev'
+        wwids, paths = [], []
+        for slave in topology.get(dev, {}).get('slaves', []):
+            if slave in seen:
+                continue
+            seen.add(slave)
+            if slave in topology:
+                if topology[slave].get('wwid'):
+                    wwids.append(topology[slave]['wwid'])
+                more_wwids, more_paths = below(slave, seen)
+                wwids.extend(more_wwids)
+                paths.extend(more_paths)
+            else:
+                paths.append(slave)
+        return wwids, paths
+
+    for dev, infos in topology.items():
+        wwids, paths = below(dev, set())
+        if infos.get('wwid'):
+            wwids.insert(0, infos['wwid'])
+        for path in paths:
+            if path not in path_states:
+                path_states[path] = \
+                    _sysfs_attr(path, 'device', 'state') or 'unknown'
+        infos['multipath'] = wwids
+        infos['paths'] = dict((path, path_states[path]) for path in paths)
+    return topology
+
+def dm_topology(*args):
     '''
-    Return informations about the existing filesystems
+    Return the device-mapper devices (LVM volumes, multipath LUNs, ...)
+    with their mapper name, uuid, type, slaves, the multipath WWIDs and
+    the underlying sd paths with their state.  The topology is read from
+    sysfs without running multipath, dmsetup or lvdisplay.
 
     CLI Example:
 
     .. code-block:: bash
 
-        salt '*' fsinfo.usage
+        salt '*' fsinfo.dm_topology
+        salt '*' fsinfo.dm_topology dm-0
     '''
-    if not os.path.isfile('/etc/mtab'):
-        log.error('df cannot run without /etc/mtab')
-        return {}
-    if not os.path.isfile('/etc/fstab'):
-        log.error('file not found: /etc/fstab')
-        return {}
+    topology = _dm_topology()
+    if not args:
+        return topology
+    try:
+        ret = dict((arg, topology[arg]) for arg in args)
+    except KeyError:
+        raise CommandExecutionError(
+            'Invalid flag passed to {0}.dm_topology'.format(__virtualname__)
+        )
+    return ret
+
+def _lvm_report(command, fields):
+    '''
+    Run the LVM reporting 'command' (lvs, pvs) and return its output as
+    a list of dictionaries (key = field name)
+    '''
+    cmd = [command, '--noheadings', '--nosuffix', '--units', 'k',
+           '--separator', '|', '-o', ','.join(fields)]
+    out = __salt__['cmd.run_all'](cmd, python_shell=False)
+    if out.get('retcode'):
+        log.warning('Error while running {0}: {1}'.format(
+            command, out.get('stderr')))
+        return []
+    return [dict(zip(fields, line.strip().split('|')))
+        for line in out.get('stdout', '').splitlines() if line.strip()]
+
+def _dm_name(vgname, lvname):
+    '''
+    Return the device-mapper name of a logical volume (the dashes in the
+    VG and LV names are doubled by LVM)
+    '''
+    return '{0}-{1}'.format(vgname.replace('-', '--'),
+                            lvname.replace('-', '--'))
+
+def _get_lvm_index():
+    '''
+    Return the LVM informations (LV size, VG name and PV devices) of all
+    the logical volumes, gathered with a single lvs and a single pvs run.
+    The index is keyed by /dev/mapper/<vg>-<lv>, /dev/<vg>/<lv> and the
+    /dev/dm-N device they resolve to.
+    '''
+    pvs_per_vg = {}
+    for pv in _lvm_report('pvs', ('pv_name', 'vg_name')):
+        if pv.get('vg_name'):
+            pvs_per_vg.setdefault(pv['vg_name'], []).append(pv['pv_name'])
 
-    # we will ignore all the filesystem with a fstype not in this list
-    fs_check_types = [
-        'autofs',
-        'ext2', 'ext3', 'ext4',
-        'nfs', 'nfs4',
-        'xfs' ]
+    index = {}
+    for lv in _lvm_report('lvs', ('vg_name', 'lv_name', 'lv_size')):
+        vgname, lvname = lv.get('vg_name'), lv.get('lv_name')
+        try:
+            lvsize = int(float(lv.get('lv_size', '')))
+        except ValueError:
+            log.warning('Error while parsing lvm info for {0}/{1}'.format(
+                vgname, lvname))
+            continue
+        pvdevices = pvs_per_vg.get(vgname, [])
+        infos = {
+            'vgname': vgname,
+            'lvsize': lvsize,
+            'pvdevice': pvdevices[0] if len(pvdevices) == 1 else pvdevices
+        }
+        dm_path = '/dev/mapper/' + _dm_name(vgname, lvname)
+        for path in (dm_path, '/dev/{0}/{1}'.format(vgname, lvname),
+                     os.path.realpath(dm_path)):
+            index[path] = infos
+    return index
+
+def _df_filesystems():
+    '''
+    Return the filesystems reported by df as a list of FileSystem tuples
+    '''
     cmd = 'df -PTk'
     cmd += ''.join([' -t %s' % fstype for fstype in fs_check_types])
     out = __salt__['cmd.run'](cmd, python_shell=False).splitlines()
@@ -96,43 +312,529 @@ def usage(human_readable=True):
     #  Filesystem Type 1024-blocks   Used Available Capacity Mounted on
     #  /dev/vg/lv ext4     1998672 352472   1541344      19% /var
     #  ...
-    cols = ('filesystem', 'fstype', 'blocks', 'used',
-            'available', 'capacity', 'mountpoint')
-    FileSystem = collections.namedtuple("Filesystem", cols)
-
     header = lambda line: line.startswith('Filesystem')
     error = lambda line: line.startswith('df:')
-    data = (FileSystem(*line.split()) for line in out
-        if not header(line) and not error(line))
+    return [FileSystem(*line.split()) for line in out
+        if not header(line) and not error(line)]
+
+def _mountinfo():
+    '''
+    Return the (device, fstype, mountpoint, major:minor) of the mounted
+    filesystems listed in /proc/self/mountinfo having a fstype in
+    fs_check_types
+    '''
+    mounts = {}
+    with salt.utils.fopen(mountinfo_file, 'r') as fp_:
+        for line in fp_:
+            # example:
+            #  36 35 98:0 /mnt1 /mnt/parent rw,noatime master:1 - ext3 /dev/root rw
+            fields = line.split()
+            try:
+                sep = fields.index('-', 6)
+                fstype, device = fields[sep + 1], fields[sep + 2]
+            except (ValueError, IndexError):
+                continue
+            if fstype not in fs_check_types:
+                continue
+            # a mountpoint mounted over is reported by its last entry
+            mountpoint = _fstab_unescape(fields[4])
+            mounts[mountpoint] = (
+                _fstab_unescape(device), fstype, mountpoint, fields[2])
+    return list(mounts.values())
+
+def _statvfs_all(mountpoints, timeout, jobs):
+    '''
+    Run os.statvfs on 'mountpoints' in at most 'jobs' daemon threads and
+    return a dictionary (key = mountpoint, value = statvfs result, the
+    OSError raised, or None when the call did not complete within
+    'timeout' seconds)
+    '''
+    results = dict((mountpoint, None) for mountpoint in mountpoints)
+    done = threading.Condition()
+    pending, running, finished = [], {}, set()
+
+    for mountpoint in mountpoints:
+        hung = _hung_statvfs.get(mountpoint)
+        if hung is not None and hung.is_alive():
+            # do not pile up more threads on a mount still blocked
+            continue
+        _hung_statvfs.pop(mountpoint, None)
+        pending.append(mountpoint)
+
+    def worker(mountpoint):
+        try:
+            stat = os.statvfs(mountpoint)
+        except OSError as err:
+            stat = err
+        with done:
+            results[mountpoint] = stat
+            finished.add(mountpoint)
+            done.notify()
+
+    with done:
+        while pending or running:
+            while pending and len(running) < jobs:
+                mountpoint = pending.pop(0)
+                thread = threading.Thread(target=worker, args=(mountpoint,))
+                thread.daemon = True
+                thread.start()
+                running[mountpoint] = (thread, time.time() + timeout)
+            now = time.time()
+            for mountpoint, (thread, deadline) in list(running.items()):
+                if mountpoint in finished:
+                    del running[mountpoint]
+                elif now >= deadline:
+                    log.warning('statvfs timed out on {0}'.format(mountpoint))
+                    _hung_statvfs[mountpoint] = thread
+                    del running[mountpoint]
+            if running:
+                done.wait(min(deadline for _, deadline in running.values())
+                          - now)
+    return results
+
+def _native_filesystems(timeout, jobs):
+    '''
+    Return the filesystems listed in /proc/self/mountinfo as a list of
+    FileSystem tuples (sizes in 1024-blocks, or None for a stale mount)
+    and a dictionary with their status and inode usage
+    '''
+    mounts = _mountinfo()
+    stats = _statvfs_all(
+        [mountpoint for _, fstype, mountpoint, _ in mounts
+            if fstype != 'autofs'],
+        timeout, jobs)
+
+    data, extra = [], {}
+    for device, fstype, mountpoint, _ in mounts:
+        if fstype == 'autofs':
+            # do not trigger the automounter: df reports zeros too
+            data.append(FileSystem(device, fstype, 0, 0, 0, '-', mountpoint))
+            extra[mountpoint] = {'status': 'ok'}
+            continue
+        st = stats.get(mountpoint)
+        if st is None or isinstance(st, OSError):
+            data.append(FileSystem(
+                device, fstype, None, None, None, None, mountpoint))
+            extra[mountpoint] = {'status': 'stale'} if st is None else \
+                {'status': 'error', 'error': str(st)}
+            continue
+        kb = lambda blocks: blocks * st.f_frsize // 1024
+        blocks, used = kb(st.f_blocks), kb(st.f_blocks - st.f_bfree)
+        available = kb(st.f_bavail)
+        capacity = '{0}%'.format(
+            -(-100 * used // (used + available)) if used + available else 0)
+        data.append(FileSystem(
+            device, fstype, blocks, used, available, capacity, mountpoint))
+        extra[mountpoint] = {
+            'status': 'ok',
+            'inodes': st.f_files,
+            'inodes-used': st.f_files - st.f_ffree,
+            'inodes-available': st.f_favail,
+        }
+    return (data, extra)
+
+def _read_diskstats():
+    '''
+    Return the counters of all the block devices found in /proc/diskstats
+    (key = major:minor, value = (device name, list of counters))
+    '''
+    stats = {}
+    with salt.utils.fopen(diskstats_file, 'r') as fp_:
+        content = fp_.read()
+    for line in content.splitlines():
+        # major minor name reads rmerged rsectors rms writes wmerged
+        #   wsectors wms inflight ioms weightedms ...
+        fields = line.split()
+        if len(fields) < 14:
+            continue
+        stats['{0}:{1}'.format(fields[0], fields[1])] = (
+            fields[2], [int(value) for value in fields[3:14]])
+    return stats
+
+def _block_slaves(name):
+    '''
+    Return the devices stacked below the block device 'name' (ex. the
+    multipath device and the sd paths below a LVM volume), top down
+    '''
+    slaves = []
+    try:
+        names = sorted(os.listdir(os.path.join(sysfs_block, name, 'slaves')))
+    except OSError:
+        return slaves
+    for slave in names:
+        slaves.append(slave)
+        slaves.extend(dev for dev in _block_slaves(slave) if dev not in slaves)
+    return slaves
+
+def _io_rates(previous, current, interval):
+    '''
+    Return the IOPS, the throughput (kB/s), the average wait (ms) and the
+    utilization (%) computed from two /proc/diskstats samples
+    '''
+    delta = [cur - prev for cur, prev in zip(current, previous)]
+    reads, rsectors, rms = delta[0], delta[2], delta[3]
+    writes, wsectors, wms = delta[4], delta[6], delta[7]
+    ioms = delta[9]
+    ios = reads + writes
+    return {
+        'r/s': round(reads / interval, 2),
+        'w/s': round(writes / interval, 2),
+        'rkB/s': round(rsectors / 2 / interval, 2),
+        'wkB/s': round(wsectors / 2 / interval, 2),
+        'await': round((rms + wms) / ios, 2) if ios else 0.0,
+        'util': round(min(100.0, ioms / (interval * 10)), 2),
+    }
+
+def iostats(interval=1):
+    '''
+    Return the I/O load of each mounted block filesystem computed from two
+    /proc/diskstats samples taken 'interval' seconds apart: read and write
+    IOPS, throughput in kB/s, average wait in ms and utilization.
+    The same statistics are returned for the devices stacked below the
+    filesystem device (LVM, multipath and sd paths).
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' fsinfo.iostats
+        salt '*' fsinfo.iostats interval=5
+    '''
+    try:
+        interval = float(interval)
+    except (TypeError, ValueError):
+        interval = 0
+    if interval <= 0:
+        raise CommandExecutionError(
+            'Invalid interval passed to {0}.iostats'.format(__virtualname__)
+        )
+
+    try:
+        mounts = _mountinfo()
+        previous = _read_diskstats()
+        time.sleep(interval)
+        current = _read_diskstats()
+    except (IOError, OSError) as err:
+        raise CommandExecutionError(
+            'An error has occurred while reading the I/O statistics: '
+            '{0}'.format(err)
+        )
+
+    names = dict((name, devno) for devno, (name, _) in current.items())
+    def rates(devno):
+        if devno not in previous:
+            return None
+        return _io_rates(previous[devno][1], current[devno][1], interval)
+
+    ret = {}
+    for device, fstype, mountpoint, devno in mounts:
+        if devno not in current:
+            # not a block device (ex. nfs)
+            continue
+        name = current[devno][0]
+        infos = {
+            'device': device,
+            'blockdev': name,
+            'stats': rates(devno),
+        }
+        slaves = _block_slaves(name)
+        if slaves:
+            infos['slaves'] = dict((slave, rates(names[slave]))
+                for slave in slaves if slave in names)
+        ret[mountpoint] = infos
+    return ret
+
+def _trend_options():
+    '''
+    Return the directory and the number of samples of the trend store
+    (minion configuration: fsinfo_trend_dir, fsinfo_trend_samples)
+    '''
+    opts = globals().get('__opts__', {})
+    directory = opts.get('fsinfo_trend_dir', os.path.join(
+        opts.get('cachedir', '/var/cache/salt/minion'), 'fsinfo_trend'))
+    return (directory, int(opts.get('fsinfo_trend_samples', 1000)))
+
+def _trend_file(directory, mountpoint):
+    '''
+    Return the path of the trend file of 'mountpoint'
+    '''
+    name = ''.join(c if c.isalnum() or c in '-._' else '%{0:02X}'.format(ord(c))
+        for c in mountpoint)
+    return os.path.join(directory, name + '.trend')
+
+def _trend_mountpoint(filename):
+    '''
+    Return the mountpoint whose trend file is 'filename'
+    '''
+    name, chunks = filename[:-len('.trend')].split('%'), []
+    chunks.append(name[0])
+    for chunk in name[1:]:
+        chunks.append(chr(int(chunk[:2], 16)) + chunk[2:])
+    return ''.join(chunks)
+
+class _TrendBuffer(object):
+    '''
+    Ring buffer of capacity samples of a mountpoint.
+    The header keeps the sums needed by a least squares fit (times are
+    relative to the latest sample), so that appending a sample and
+    computing the fit only read the header and one or two records.
+    '''
+    def __init__(self, fp_, capacity, mountpoint):
+        self.fp_ = fp_
+        header = fp_.read(_trend_header.size)
+        if len(header) == _trend_header.size:
+            fields = _trend_header.unpack(header)
+            if fields[0] != _trend_magic:
+                raise CommandExecutionError(
+                    'Not a trend file for {0}'.format(mountpoint))
+            (self.capacity, self.count, self.pos, self.base) = fields[1:5]
+            self.sums = list(fields[5:])
+        else:
+            self.capacity, self.count, self.pos, self.base = capacity, 0, 0, 0.0
+            self.sums = [0.0] * 6
+
+    def record(self, index):
+        self.fp_.seek(_trend_header.size + index * _trend_record.size)
+        return _trend_record.unpack(self.fp_.read(_trend_record.size))
+
+    def records(self):
+        '''Return the samples from the oldest to the latest'''
+        first = self.pos if self.count == self.capacity else 0
+        return [self.record((first + i) % self.capacity)
+            for i in range(self.count)]
+
+    def _account(self, rec, sign):
+        # sums: t, t*t, used, t*used, inodes used, t*inodes used
+        t = rec[0] - self.base
+        for i, value in enumerate(
+                (t, t * t, rec[1], t * rec[1], rec[3], t * rec[3])):
+            self.sums[i] += sign * value
+
+    def append(self, rec):
+        # rebase the sums on the time of the new sample
+        delta, n = rec[0] - self.base, self.count
+        st, stt, su, stu, si, sti = self.sums
+        self.sums = [st - n * delta, stt - 2 * delta * st + n * delta * delta,
+                     su, stu - delta * su, si, sti - delta * si]
+        self.base = rec[0]
+
+        if self.count == self.capacity:
+            self._account(self.record(self.pos), -1)
+            self.count -= 1
+        self.fp_.seek(_trend_header.size + self.pos * _trend_record.size)
+        self.fp_.write(_trend_record.pack(*rec))
+        self._account(rec, 1)
+        self.count += 1
+        self.pos = (self.pos + 1) % self.capacity
+        if self.pos == 0:
+            # recompute the sums once per round to cancel rounding errors
+            self.sums = [0.0] * 6
+            for old in self.records():
+                self._account(old, 1)
+
+        self.fp_.seek(0)
+        self.fp_.write(_trend_header.pack(_trend_magic, self.capacity,
+            self.count, self.pos, self.base, *self.sums))
+
+    def slopes(self):
+        '''
+        Return the growth per second of the used blocks and of the used
+        inodes, or None when it cannot be computed
+        '''
+        st, stt, su, stu, si, sti = self.sums
+        n = self.count
+        det = n * stt - st * st
+        if n < 2 or det <= 0:
+            return None
+        return ((n * stu - st * su) / det, (n * sti - st * si) / det)
+
+def _open_trend(mountpoint, create=False):
+    '''
+    Return the trend file of 'mountpoint' opened and locked, or None
+    '''
+    directory, _ = _trend_options()
+    filename = _trend_file(directory, mountpoint)
+    if create and not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    try:
+        fd = os.open(filename, os.O_RDWR | (os.O_CREAT if create else 0), 0o600)
+    except OSError:
+        if create:
+            raise
+        return None
+    fp_ = os.fdopen(fd, 'r+b')
+    fcntl.flock(fp_.fileno(), fcntl.LOCK_EX)
+    return fp_
+
+def _record_trend(data, extra):
+    '''
+    Append the used blocks and inodes of the filesystems 'data' to their
+    trend files
+    '''
+    now = time.time()
+    _, capacity = _trend_options()
+    for fs in data:
+        if fs.blocks is None or fs.fstype == 'autofs':
+            continue
+        inodes = extra.get(fs.mountpoint, {})
+        rec = (now, int(fs.used), int(fs.available),
+               inodes.get('inodes-used', 0), inodes.get('inodes-available', 0))
+        try:
+            fp_ = _open_trend(fs.mountpoint, create=True)
+            with fp_:
+                _TrendBuffer(fp_, capacity, fs.mountpoint).append(rec)
+        except (IOError, OSError, CommandExecutionError) as err:
+            log.warning('Cannot record the trend of {0}: {1}'.format(
+                fs.mountpoint, err))
+
+def forecast(*mountpoints):
+    '''
+    Return the growth rate (per day) and the estimated time to full (in
+    days, until the available space and inodes as reported by df are
+    exhausted) of the used space and inodes of the mountpoints, computed
+    with a linear fit over the samples recorded by fsinfo.usage trend=True.
+    Only the header and the latest record of each trend file are read.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' fsinfo.forecast
+        salt '*' fsinfo.forecast / /var
+    '''
+    directory, capacity = _trend_options()
+    if not mountpoints:
+        try:
+            mountpoints = [_trend_mountpoint(name)
+                for name in os.listdir(directory) if name.endswith('.trend')]
+        except OSError:
+            mountpoints = []
+
+    day = 86400.0
+    ret = {}
+    for mountpoint in mountpoints:
+        fp_ = _open_trend(mountpoint)
+        if fp_ is None:
+            continue
+        with fp_:
+            trend = _TrendBuffer(fp_, capacity, mountpoint)
+            if not trend.count:
+                continue
+            latest = trend.record((trend.pos - 1) % trend.capacity)
+            slopes = trend.slopes()
+
+        infos = {'samples': trend.count, 'last_sample': latest[0]}
+        if slopes is None:
+            ret[mountpoint] = infos
+            continue
+        for name, slope, used, available in (
+                ('used', slopes[0], latest[1], latest[2]),
+                ('inodes', slopes[1], latest[3], latest[4])):
+            if name == 'inodes' and not used + available:
+                continue
+            # what is left to unprivileged users (df Available): the
+            # blocks reserved to root are not counted
+            infos[name + '-growth'] = round(slope * day, 2)
+            infos[name + '-days-to-full'] = \
+                round(available / slope / day, 2) if slope > 0 else None
+        ret[mountpoint] = infos
+    return ret
+
+def usage(human_readable=True, native=False, timeout=5, jobs=8, trend=False):
+    '''
+    Return informations about the existing filesystems
+
+    With native=True df is not run: the mounts are read from
+    /proc/self/mountinfo and os.statvfs is called on each of them in at
+    most 'jobs' threads (at least one).  A mount not answering within
+    'timeout' seconds (ex. a stale NFS mount) is reported with status
+    'stale'.
+    The inode usage is also returned in this mode.
+
+    With trend=True the used space (and inodes, in native mode) of each
+    filesystem is appended to its trend file, for fsinfo.forecast.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' fsinfo.usage
+        salt '*' fsinfo.usage native=True timeout=2
+        salt '*' fsinfo.usage native=True trend=True
+    '''
+    if not os.path.isfile(fstab_file):
+        log.error('file not found: {0}'.format(fstab_file))
+        return {}
+
+    extra = {}
+    if native:
+        try:
+            timeout, jobs = float(timeout), max(1, int(jobs))
+        except (TypeError, ValueError):
+            timeout = 0
+        if timeout <= 0:
+            raise CommandExecutionError(
+                'Invalid timeout or jobs passed to {0}.usage'.format(
+                    __virtualname__)
+            )
+        try:
+            data, extra = _native_filesystems(timeout, jobs)
+        except (IOError, OSError):
+            log.error('Error while reading {0}'.format(mountinfo_file))
+            return {}
+    else:
+        if not os.path.isfile('/etc/mtab'):
+            log.error('df cannot run without /etc/mtab')
+            return {}
+        data = _df_filesystems()
+
+    if trend:
+        _record_trend(data, extra)
+
     bool2str = lambda b: 'true' if b else 'false'
 
-    def automount(device):
-        '''Check whether 'device' is configured for automount in fstab'''
-        return __salt__['file.grep']('/etc/fstab', '^%s\s' % device)
+    fstab = _parse_fstab()
+    lvm = _get_lvm_index()
+    dm = _dm_topology()
+    def automount(entry):
+        '''Check whether the fstab 'entry' is configured for automount'''
+        return entry is not None and \
+            'noauto' not in entry.options.split(',')
 
     fmt = lambda num: _sizeof_fmt(num) if human_readable else int(num)
     def fsinfos(fs):
         '''Return a dictionary containing the filesystem informations'''
+        entry = _fstab_lookup(fstab, fs.filesystem)
         infos = {
             'autofs': bool2str(fs.fstype == 'autofs'),
-            'automount': 'true' if automount(fs.filesystem) else 'false',
-            'available': fmt(fs.available),
+            'automount': bool2str(automount(entry)),
             'device': fs.filesystem,
             'fstype': fs.fstype,
             'mountpoint': fs.mountpoint,
-            'size': fmt(fs.blocks),
-            'used': fmt(fs.used)
         }
-        lvm_infos = _get_lvm_infos(fs.filesystem)
+        if fs.blocks is not None:
+            infos['available'] = fmt(fs.available)
+            infos['size'] = fmt(fs.blocks)
+            infos['used'] = fmt(fs.used)
+        infos.update(extra.get(fs.mountpoint, {}))
+        if entry is not None:
+            infos['options'] = entry.options
+            infos['passno'] = entry.passno
+        lvm_infos = lvm.get(fs.filesystem, {})
+        if not lvm_infos and fs.filesystem.startswith('/dev/'):
+            lvm_infos = lvm.get(os.path.realpath(fs.filesystem), {})
         lvsize = lvm_infos.get('lvsize', None)
         vgname = lvm_infos.get('vgname', None)
         if lvsize:
             infos['lvm-lvsize'] = fmt(lvsize)
         if vgname:
             infos['lvm-vgname'] = vgname
-            physical_volume_device = _get_physical_volume_device(vgname)
-            if physical_volume_device:
-                infos['lvm-pvdevice'] = physical_volume_device
+            if lvm_infos.get('pvdevice'):
+                infos['lvm-pvdevice'] = lvm_infos['pvdevice']
+        if fs.filesystem.startswith('/dev/'):
+            dm_infos = dm.get(os.path.basename(os.path.realpath(fs.filesystem)))
+            if dm_infos and dm_infos['multipath']:
+                infos['multipath'] = dm_infos['multipath']
         return infos
 
     return dict((fs.mountpoint, fsinfos(fs)) for fs in data)
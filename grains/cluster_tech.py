@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+'''
+SaltStack code snippets.
+Custom grain reporting the cluster technology running on the node.
+
+The detection is done by the execution module cluster (cluster.py), that
+must be synced on the minion too.  The result is cached in the minion
+cache directory for 'cluster_tech_cache_ttl' seconds (minion
+configuration, default: 300).  Set 'grains_refresh_every' in the minion
+configuration to refresh the grains periodically.
+
+Copyright (C) 2017 Davide Madrisan <davide.madrisan.gmail.com>
+'''
+# Import python libs
+import logging
+import os
+import tempfile
+import time
+
+log = logging.getLogger(__name__)
+
+# the execution module cluster, loaded by _cluster_module()
+_cluster = None
+
+def _cluster_module():
+    '''
+    Load and return the execution module cluster, looked for in the
+    modules directory next to the grains one (minion extension modules)
+    and then in the parent directory (this repository), or None
+    '''
+    global _cluster
+    if _cluster is not None:
+        return _cluster
+
+    basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for path in (os.path.join(basedir, 'modules', 'cluster.py'),
+                 os.path.join(basedir, 'cluster.py')):
+        if os.path.isfile(path):
+            break
+    else:
+        log.debug('The execution module cluster cannot be found')
+        return None
+
+    name = '_cluster_tech_cluster'
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except ImportError:
+        # Python 2
+        import imp
+        module = imp.load_source(name, path)
+    _cluster = module
+    return _cluster
+
+def _detect():
+    '''
+    Return the cluster technology running on this node, or 'none'
+    '''
+    cluster = _cluster_module()
+    if cluster is None:
+        return 'none'
+    daemon = cluster._running_daemon()
+    return dict(cluster.cluster_daemons).get(daemon, 'none')
+
+def cluster_tech():
+    '''
+    Return the grain 'cluster_tech'
+    '''
+    opts = globals().get('__opts__', {})
+    ttl = int(opts.get('cluster_tech_cache_ttl', 300))
+    cachedir = opts.get('cachedir', '/var/cache/salt/minion')
+    cachefile = os.path.join(cachedir, 'cluster_tech.cache')
+
+    try:
+        if time.time() - os.stat(cachefile).st_mtime < ttl:
+            with open(cachefile, 'r') as fp_:
+                technology = fp_.read().strip()
+            if technology:
+                return {'cluster_tech': technology}
+    except (IOError, OSError):
+        pass
+
+    technology = _detect()
+    # write a temporary file and rename it, so that a concurrent reader
+    # never sees a partially written cache
+    try:
+        fd, tmpfile = tempfile.mkstemp(prefix='.cluster_tech.', dir=cachedir)
+        try:
+            with os.fdopen(fd, 'w') as fp_:
+                fp_.write(technology)
+            os.rename(tmpfile, cachefile)
+        except (IOError, OSError):
+            os.unlink(tmpfile)
+            raise
+    except (IOError, OSError) as err:
+        log.debug('Cannot write {0}: {1}'.format(cachefile, err))
+    return {'cluster_tech': technology}
@@ -6,13 +6,73 @@ Check the network bonding topology.
 Copyright (C) 2017 Davide Madrisan <davide.madrisan.gmail.com>
 '''
 # Import 3rd-party libs
+import json
+import logging
 import os
+import tempfile
+import time
 
 # Import salt libs
 import salt.utils
+from salt.exceptions import CommandExecutionError
+
+log = logging.getLogger(__name__)
 
 __virtualname__ = 'linux_bonding'
 proc_net_bonding = '/proc/net/bonding'
+sysfs_net = '/sys/class/net'
+sysfs_bonding_version = '/sys/module/bonding/version'
+proc_net_dev = '/proc/net/dev'
+proc_uptime = '/proc/uptime'
+
+# the counters of /proc/net/dev reported by rates(), with their column
+net_dev_counters = (
+    ('rx_bytes', 0), ('rx_packets', 1), ('rx_errors', 2), ('rx_dropped', 3),
+    ('tx_bytes', 8), ('tx_packets', 9), ('tx_errors', 10), ('tx_dropped', 11),
+)
+
+# the file of the minion cache directory holding the last /proc/net/dev
+# sample, used by rates(interval=0): the minion runs each job in a new
+# process, so a module global would not survive between the calls
+net_sample_file = 'linux_bonding_net_sample.json'
+
+# the bonding modes, as displayed in /proc/net/bonding/<bond>
+bonding_modes = {
+    'balance-rr': 'load balancing (round-robin)',
+    'active-backup': 'fault-tolerance (active-backup)',
+    'balance-xor': 'load balancing (xor)',
+    'broadcast': 'fault-tolerance (broadcast)',
+    '802.3ad': 'IEEE 802.3ad Dynamic link aggregation',
+    'balance-tlb': 'transmit load balancing',
+    'balance-alb': 'adaptive load balancing',
+}
+
+# the bond attributes read from /sys/class/net/<bond>/ and reported
+# with the keys of the /proc/net/bonding/<bond> parser:
+# (key, sysfs attribute, conversion function)
+sysfs_bond_attrs = (
+    ('bonding_mode', 'bonding/mode',
+        lambda value: bonding_modes.get(value.split()[0], value)),
+    ('currently_active_slave', 'bonding/active_slave',
+        lambda value: value or 'None'),
+    ('primary_slave', 'bonding/primary', lambda value: value or 'None'),
+    ('mii_status', 'bonding/mii_status', None),
+    ('mii_polling_interval_(ms)', 'bonding/miimon', None),
+    ('up_delay_(ms)', 'bonding/updelay', None),
+    ('down_delay_(ms)', 'bonding/downdelay', None),
+    ('slave_interfaces', 'bonding/slaves', lambda value: value.split()),
+)
+
+# the same for the attributes read from /sys/class/net/<slave>/
+sysfs_slave_attrs = (
+    ('mii_status', 'bonding_slave/mii_status', None),
+    ('speed', 'speed', lambda value: '{0} Mbps'.format(value)),
+    ('duplex', 'duplex', None),
+    ('link_failure_count', 'bonding_slave/link_failure_count', None),
+    ('permanent_hw_addr', 'bonding_slave/perm_hwaddr', None),
+    ('slave_queue_id', 'bonding_slave/queue_id', None),
+    ('aggregator_id', 'bonding_slave/ad_aggregator_id', None),
+)
 
 def __virtual__():
     '''
@@ -24,20 +84,95 @@ def __virtual__():
                        __virtualname__))
     return True
 
-def _get_proc_bonding_files():
-    bonding_interface_paths = __salt__['file.find'](
-        proc_net_bonding,
-        mindepth=1,
-        maxdepth=1
-    )
-    return bonding_interface_paths
+def _list_dir(path):
+    '''
+    Return the names of the entries of the directory 'path', or an
+    empty list.  os.scandir is used when available (Python 3.5+).
+    '''
+    try:
+        if hasattr(os, 'scandir'):
+            return sorted(entry.name for entry in os.scandir(path))
+        return sorted(os.listdir(path))
+    except OSError:
+        return []
+
+def _read_attr(iface, attr):
+    '''
+    Return the value of the sysfs attribute 'attr' of the network
+    interface 'iface', or None when it does not exist or cannot be read
+    (ex. the speed of a link down)
+    '''
+    try:
+        with salt.utils.fopen(
+                os.path.join(sysfs_net, iface, attr), 'r') as fp_:
+            return fp_.read().strip()
+    except (IOError, OSError):
+        return None
+
+def _read_attrs(iface, attrs, fields=None):
+    '''
+    Return the sysfs attributes 'attrs' (see sysfs_bond_attrs) of 'iface',
+    restricted to the keys 'fields' when given
+    '''
+    data = dict()
+    for key, attr, convert in attrs:
+        if fields is not None and key not in fields:
+            continue
+        value = _read_attr(iface, attr)
+        if value is None and key == 'mii_status':
+            # bonding/mii_status is not available on older kernels
+            value = _read_attr(iface, 'operstate')
+        if value is not None:
+            data[key] = convert(value) if convert else value
+    return data
+
+def _has_sysfs_bonding(bond):
+    return os.path.isdir(os.path.join(sysfs_net, bond, 'bonding'))
+
+def _drop_mode_attrs(bond, data):
+    '''
+    Remove from the sysfs attributes 'data' of 'bond' the active and
+    primary slaves when its bonding mode has none, as /proc/net/bonding
+    does not report them either
+    '''
+    if 'currently_active_slave' not in data and 'primary_slave' not in data:
+        return data
+    mode = _read_attr(bond, 'bonding/mode') or ''
+    if not mode.startswith(('active-backup', 'balance-tlb', 'balance-alb')):
+        data.pop('currently_active_slave', None)
+    if not mode.startswith('active-backup'):
+        data.pop('primary_slave', None)
+    return data
+
+def _parse_sysfs_bond(bond):
+    '''
+    Return the informations of 'bond' read from sysfs, with the same
+    keys as the ones returned by _parse_proc_bond_file
+    '''
+    data = _drop_mode_attrs(bond, _read_attrs(bond, sysfs_bond_attrs))
+
+    version = None
+    try:
+        with salt.utils.fopen(sysfs_bonding_version, 'r') as fp_:
+            version = fp_.read().strip()
+    except (IOError, OSError):
+        pass
+    if version:
+        data['ethernet_channel_bonding_driver'] = 'v' + version
+
+    for slave in data.setdefault('slave_interfaces', []):
+        data[slave] = _read_attrs(slave, sysfs_slave_attrs)
+    return data
 
 def _parse_proc_bond_file(procfile):
     data = dict()
     slave_interface = None
     slave_interfaces = list()
     with salt.utils.fopen(procfile, 'r') as fp_:
-        for descr, value in [elm.split(':', 1) for elm in fp_ if elm.strip()]:
+        for line in fp_:
+            descr, sep, value = line.partition(':')
+            if not sep:
+                continue
             key = descr.strip().lower().replace(' ', '_')
             if key == 'slave_interface':
                 slave_interface = value.strip()
@@ -49,6 +184,91 @@ def _parse_proc_bond_file(procfile):
         data['slave_interfaces'] = slave_interfaces
     return data
 
+def _read_net_dev():
+    '''
+    Return the time and the counters of all the network interfaces,
+    read in a single pass of /proc/net/dev (key = interface name,
+    value = list of counters)
+    '''
+    try:
+        with salt.utils.fopen(proc_net_dev, 'r') as fp_:
+            content = fp_.read()
+    except (IOError, OSError):
+        raise CommandExecutionError(
+            'An error has occurred while reading {0}'.format(proc_net_dev)
+        )
+    counters = dict()
+    for line in content.splitlines()[2:]:
+        iface, sep, values = line.partition(':')
+        if sep:
+            counters[iface.strip()] = [int(value) for value in values.split()]
+    return (time.time(), counters)
+
+def _boot_sample():
+    '''
+    Return a sample with all the counters to zero taken at boot time
+    '''
+    try:
+        with salt.utils.fopen(proc_uptime, 'r') as fp_:
+            uptime = float(fp_.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        uptime = 0
+    return (time.time() - uptime, dict())
+
+def _sample_path(filename):
+    '''
+    Return the path of 'filename' in the minion cache directory
+    '''
+    opts = globals().get('__opts__', {})
+    return os.path.join(
+        opts.get('cachedir', '/var/cache/salt/minion'), filename)
+
+def _load_sample(filename):
+    '''
+    Return the sample saved in the minion cache directory, or None
+    '''
+    try:
+        with salt.utils.fopen(_sample_path(filename), 'r') as fp_:
+            return json.load(fp_)
+    except (IOError, OSError, ValueError):
+        return None
+
+def _save_sample(filename, sample):
+    '''
+    Save 'sample' in the minion cache directory.  A temporary file is
+    renamed, so that a concurrent call never reads a partial sample.
+    '''
+    path = _sample_path(filename)
+    try:
+        fd, tmpfile = tempfile.mkstemp(
+            prefix='.' + filename + '.', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w') as fp_:
+                json.dump(sample, fp_)
+            os.rename(tmpfile, path)
+        except (IOError, OSError):
+            os.unlink(tmpfile)
+            raise
+    except (IOError, OSError) as err:
+        log.debug('Cannot write {0}: {1}'.format(path, err))
+
+def _bond_slaves(bond):
+    slaves = _read_attr(bond, 'bonding/slaves')
+    if slaves is not None:
+        return slaves.split()
+    return _parse_proc_bond_file(
+        os.path.join(proc_net_bonding, bond))['slave_interfaces']
+
+def _imbalance(rates):
+    '''
+    Return the ratio between the busiest slave and the average of the
+    slaves (1.0: traffic evenly spread, N: all the traffic on one of the
+    N slaves), or None when there is no traffic
+    '''
+    if not rates or not sum(rates):
+        return None
+    return round(max(rates) * len(rates) / float(sum(rates)), 2)
+
 def device_list():
     '''
     Return the list of the bonding device
@@ -59,14 +279,13 @@ def device_list():
 
             salt '*' linux_bonding.device_list
     '''
-    bonding_interface_paths = _get_proc_bonding_files()
-    devices = [os.path.basename(procfile)
-        for procfile in bonding_interface_paths]
-    return devices
+    return _list_dir(proc_net_bonding)
 
 def topology():
     '''
-    Return the topology of the network bonding
+    Return the topology of the network bonding.
+    The informations are read from /sys/class/net when available, and
+    from /proc/net/bonding otherwise.
 
     CLI Example:
 
@@ -74,8 +293,118 @@ def topology():
 
             salt '*' linux_bonding.topology
     '''
-    bonding_interface_paths = _get_proc_bonding_files()
-    infos = dict(
-        (os.path.basename(procfile), _parse_proc_bond_file(procfile))
-            for procfile in bonding_interface_paths)
+    infos = dict()
+    for bond in device_list():
+        if _has_sysfs_bonding(bond):
+            infos[bond] = _parse_sysfs_bond(bond)
+        else:
+            infos[bond] = _parse_proc_bond_file(
+                os.path.join(proc_net_bonding, bond))
     return infos
+
+def status(bond, fields=None):
+    '''
+    Return the status of the bond 'bond' only, read from sysfs.
+    'fields' restricts the output to the given keys (a list or a comma
+    separated string), so that only the matching sysfs attributes are read.
+    Available fields: bonding_mode, currently_active_slave, primary_slave,
+    mii_status, mii_polling_interval_(ms), up_delay_(ms), down_delay_(ms),
+    slave_interfaces.
+
+    CLI Example:
+
+        .. code-block:: bash
+
+            salt '*' linux_bonding.status bond0
+            salt '*' linux_bonding.status bond0 fields=mii_status,currently_active_slave
+    '''
+    known = set(key for key, _, _ in sysfs_bond_attrs)
+    if fields is not None:
+        if hasattr(fields, 'split'):
+            fields = [field.strip() for field in fields.split(',')]
+        unknown = [field for field in fields if field not in known]
+        if unknown:
+            raise CommandExecutionError(
+                'Invalid field passed to {0}.status: {1}'.format(
+                    __virtualname__, ','.join(unknown))
+            )
+
+    if _has_sysfs_bonding(bond):
+        return _drop_mode_attrs(
+            bond, _read_attrs(bond, sysfs_bond_attrs, fields))
+
+    procfile = os.path.join(proc_net_bonding, bond)
+    if not os.path.isfile(procfile):
+        raise CommandExecutionError(
+            'No such bonding device: {0}'.format(bond)
+        )
+    wanted = known if fields is None else set(fields)
+    return dict((key, value)
+        for key, value in _parse_proc_bond_file(procfile).items()
+            if key in wanted)
+
+def rates(interval=1):
+    '''
+    Return the received and transmitted bytes, packets, errors and drops
+    per second of each bond and of its slaves, computed from two samples
+    of the interface counters taken 'interval' seconds apart, and the
+    rx/tx imbalance ratio of each bond (the busiest slave compared to the
+    average of the slaves, 1.0 meaning an evenly balanced bond).
+
+    With interval=0 the call does not sleep and returns the rates since
+    the previous call made on this minion, whose sample is kept in the
+    minion cache directory ('since' is then 'previous call'), or since
+    boot for the first call ('since' is then 'boot').
+
+    CLI Example:
+
+        .. code-block:: bash
+
+            salt '*' linux_bonding.rates
+            salt '*' linux_bonding.rates interval=5
+            salt '*' linux_bonding.rates interval=0
+    '''
+    try:
+        interval = float(interval)
+    except (TypeError, ValueError):
+        raise CommandExecutionError(
+            'Invalid interval passed to {0}.rates: {1}'.format(
+                __virtualname__, interval)
+        )
+
+    bonds = dict((bond, _bond_slaves(bond)) for bond in device_list())
+    since = None
+    if interval > 0:
+        previous = _read_net_dev()
+        time.sleep(interval)
+    else:
+        previous, boot = _load_sample(net_sample_file), _boot_sample()
+        if not previous or previous[0] < boot[0]:
+            # no sample, or a sample taken before a reboot
+            previous, since = boot, 'boot'
+        else:
+            since = 'previous call'
+    current = _read_net_dev()
+    _save_sample(net_sample_file, current)
+
+    elapsed = current[0] - previous[0]
+    def iface_rates(iface):
+        now = current[1].get(iface)
+        if now is None or elapsed <= 0:
+            return None
+        before = previous[1].get(iface, [0] * len(now))
+        return dict((name, round((now[col] - before[col]) / elapsed, 2))
+            for name, col in net_dev_counters)
+
+    ret = dict()
+    for bond, slaves in bonds.items():
+        data = iface_rates(bond) or dict()
+        data['slaves'] = dict((slave, iface_rates(slave)) for slave in slaves)
+        if since:
+            data['since'] = since
+        slave_rates = [rate for rate in data['slaves'].values() if rate]
+        data['imbalance'] = dict((direction, _imbalance(
+            [rate[direction + '_bytes'] for rate in slave_rates]))
+                for direction in ('rx', 'tx'))
+        ret[bond] = data
+    return ret
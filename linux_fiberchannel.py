@@ -29,6 +29,7 @@ def __virtual__():
     return True
 
 sysfs_fc_host = '/sys/class/fc_host'
+sysfs_block = '/sys/class/block'
 
 def _fc_host_list():
     '''
@@ -85,3 +86,63 @@ def show(*args):
             'Invalid flag passed to {0}.show'.format(__virtualname__)
         )
     return ret
+
+def _scsi_address(path):
+    '''
+    Return the SCSI address (host:channel:target:lun) of the sd device
+    'path', or None
+    '''
+    device = os.path.realpath(os.path.join(sysfs_block, path, 'device'))
+    address = os.path.basename(device)
+    return address if address.count(':') == 3 else None
+
+def luns(*args):
+    '''
+    Return the multipath LUNs with their WWID, device-mapper device and
+    the state, SCSI address and fiber channel host of each path, from
+    the device-mapper topology read from sysfs (see fsinfo.dm_topology).
+
+    CLI Example:
+
+        .. code-block:: bash
+
+            salt '*' linux_fiberchannel.luns
+            salt '*' linux_fiberchannel.luns mpatha
+    '''
+    if 'fsinfo.dm_topology' not in __salt__:
+        raise CommandExecutionError(
+            '{0}.luns requires the fsinfo execution module'.format(
+                __virtualname__)
+        )
+    topology = __salt__['fsinfo.dm_topology']()
+
+    def _pack_path(path, state):
+        address = _scsi_address(path)
+        host = 'host' + address.split(':')[0] if address else None
+        return {
+            'state': state,
+            'hctl': address,
+            'fc_host': host if host and os.path.exists(
+                os.path.join(sysfs_fc_host, host)) else None,
+        }
+
+    data = dict()
+    for dev, infos in topology.items():
+        if infos.get('type') != 'multipath':
+            continue
+        data[infos['name']] = {
+            'dm': dev,
+            'wwid': infos['wwid'],
+            'paths': dict((path, _pack_path(path, state))
+                for path, state in infos['paths'].items()),
+        }
+
+    if not args:
+        return data
+    try:
+        ret = dict((arg, data[arg]) for arg in args)
+    except:
+        raise CommandExecutionError(
+            'Invalid flag passed to {0}.luns'.format(__virtualname__)
+        )
+    return ret
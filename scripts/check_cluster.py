@@ -13,17 +13,21 @@ __status__ = "Beta"
 
 # Import python libs
 import getopt
+import hashlib
 import itertools
+import json
+import math
 import os
+import sqlite3
 import sys
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 
 # Import salt libs
 import salt.client.ssh.client
-
-try:
-    import json
-except ImportError:
-    import simplejson as json
+from salt.exceptions import CommandExecutionError
 
 def die(message, exitcode=1):
     '''
@@ -39,99 +43,647 @@ def usage():
         'Check for system configuration issues on a Red Hat cluster',
         'Copyright (C) 2017 Davide Madrisan <davide.madrisan.gmail.com>',
         'Usage:',
-        '\t' + progname + ' --cluster <hostnames>',
+        '\t' + progname + ' --cluster <hostnames> [--jobs <N>]'
+            ' [--grains <grain>[,<grain2>,...]] [--majority]'
+            ' [--checks <check>[,<check2>,...]|all]',
+        '\t\t[--store <file> [--save-baseline <name>|--since-baseline <name>]]',
+        '\t\t[--profile] [--profile-log <file>]',
         '\t' + progname + ' -h',
         'Example:\n' + '\tsudo %s -c "cluster01,cluster02"' % progname ]:
         print(line)
 
-def saltstack_module_run(ssh_client, target, modulename, params=None):
+# the remote calls recorded when --profile is given (None: disabled)
+profile_calls = None
+profile_lock = threading.Lock()
+
+def record_call(target, modulename, start, json_out, state):
+    '''
+    Record the wall time, the size of the returned data and the final
+    state ('ok', 'error', 'exception') of a remote call
+    '''
+    if profile_calls is None:
+        return
+    try:
+        size = len(json.dumps(json_out))
+    except (TypeError, ValueError):
+        size = 0
+    call = dict(
+        target = target,
+        module = modulename,
+        start = start,
+        elapsed = time.time() - start,
+        bytes = size,
+        state = state)
+    with profile_lock:
+        profile_calls.append(call)
+
+def print_profile(calls, logfile=None):
+    '''
+    Print the number of calls and the p50/p95/max wall time and size of
+    the remote calls per host and per module, and optionally write every
+    call as a JSON line in 'logfile'
+    '''
+    def percentile(values, pct):
+        # nearest-rank method on sorted values
+        return values[max(0, int(math.ceil(pct * len(values) / 100.0)) - 1)]
+
+    for group in ('target', 'module'):
+        print('*** Remote calls per {0}'.format(group))
+        print('{0:<30} {1:>5} {2:>6} {3:>8} {4:>8} {5:>8} {6:>10}'.format(
+            group, 'calls', 'errors', 'p50 (s)', 'p95 (s)', 'max (s)',
+            'max bytes'))
+        calls_per_key = dict()
+        for call in calls:
+            calls_per_key.setdefault(call[group], []).append(call)
+        for key in sorted(calls_per_key):
+            elapsed = sorted(call['elapsed'] for call in calls_per_key[key])
+            print('{0:<30} {1:>5} {2:>6} {3:>8.3f} {4:>8.3f} {5:>8.3f} '
+                  '{6:>10}'.format(key, len(elapsed),
+                len([call for call in calls_per_key[key]
+                    if call['state'] != 'ok']),
+                percentile(elapsed, 50), percentile(elapsed, 95), elapsed[-1],
+                max(call['bytes'] for call in calls_per_key[key])))
+
+    if logfile:
+        try:
+            with open(logfile, 'a') as fp_:
+                for call in calls:
+                    fp_.write(json.dumps(call, sort_keys=True) + '\n')
+        except (IOError, OSError) as err:
+            die('cannot write {0}: {1}'.format(logfile, err))
+
+def saltstack_module_run(ssh_client, target, modulename, params=None,
+                         kwargs=None):
     '''
     Return the 'return' entry of the dict returned by SaltStack
     '''
     saltstack_get_obj = lambda data, obj: data.get(target, {}).get(obj, {})
-    json_out = (
-        ssh_client.cmd(target, modulename, params) if params
-            else ssh_client.cmd(target, modulename))
-    errmsg = saltstack_get_obj(json_out, 'stderr')
-    outmsg = saltstack_get_obj(json_out, 'stdout')
+    start, json_out, state = time.time(), {}, 'exception'
+    try:
+        json_out = ssh_client.cmd(
+            target, modulename, params or (), kwarg=kwargs)
+        errmsg = saltstack_get_obj(json_out, 'stderr')
+        outmsg = saltstack_get_obj(json_out, 'stdout')
+        state = 'error' if errmsg else 'ok'
+    finally:
+        record_call(target, modulename, start, json_out, state)
     if errmsg:
-        die('probably a BUG...\n{0} {1}'.format(errmsg, outmsg))
+        raise CommandExecutionError(
+            'probably a BUG...\n{0} {1}'.format(errmsg, outmsg))
 
     return saltstack_get_obj(json_out, 'return')
 
-def checkup(ssh_client, cluster_hostnames):
-    checks = [('groups', 'account.get_group_list'),
-        ('users', 'account.get_user_list'),
-        ('services', 'service_iana.get_service_list')]
+def run_on_hosts(pool, func, cluster_hostnames):
+    '''
+    Run 'func(target)' concurrently on all the hosts and yield the tuples
+    (target, result, error message) as soon as they are available
+    '''
+    def _run(target):
+        try:
+            return (target, func(target), None)
+        except Exception as err:
+            return (target, None, str(err) or err.__class__.__name__)
+    return pool.imap_unordered(_run, cluster_hostnames)
+
+# the grains fetched from each host (see --grains)
+grains_query = ['osarch', 'osfullname', 'osrelease_info']
+
+# A check compares across the hosts the dictionary returned by the
+# function 'salt_module', either by value ('values') or by looking only
+# at its keys ('keys'), when the values are expected to be host specific.
+# 'cost' is a rough estimate of the time the function takes on each host:
+# the most expensive checks are started first on the remote side, where
+# cluster_check.collect runs a bounded number of them at a time.
+Check = namedtuple('Check', ('name', 'salt_module', 'compare', 'cost'))
+check_registry = dict()
+
+def register_check(name, salt_module, compare='values', cost=1):
+    check_registry[name] = Check(name, salt_module, compare, cost)
+
+register_check('groups', 'account.get_group_list')
+register_check('users', 'account.get_user_list')
+register_check('services', 'service_iana.get_service_list')
+register_check('packages', 'rpmpkg.list_pkgs', cost=2)
+register_check('mounts', 'fsinfo.usage', compare='keys', cost=3)
+register_check('bonding', 'linux_bonding.topology', compare='keys')
+register_check('pacemaker', 'pacemaker.cluster_nodes_status', cost=2)
+
+# the checks selected for this run (see --checks)
+checks = [check_registry[name] for name in ('groups', 'users', 'services')]
+
+def keys_digest(table):
+    '''
+    Return the digests of 'table' with the values of the entries ignored
+    '''
+    root = hashlib.sha1()
+    for key in sorted(table['entries']):
+        root.update(u'{0}\n'.format(key).encode('utf-8'))
+    return {'root': root.hexdigest(),
+            'entries': dict.fromkeys(table['entries'], '')}
+
+def open_store(path, readonly=False):
+    '''
+    Open (and create if needed) the SQLite snapshot store 'path'.
+    A snapshot records, for a host and a check, the digests returned by
+    cluster_check.collect and the time they have been fetched; the
+    snapshot 'latest' is refreshed at each run.
+    With 'readonly' the store must already exist and it is opened without
+    taking any write lock (the workers only read the snapshots).
+    '''
+    if readonly:
+        try:
+            return sqlite3.connect(
+                'file:{0}?mode=ro'.format(path), timeout=60, uri=True)
+        except TypeError:
+            # Python 2: no URI filenames
+            return sqlite3.connect(path, timeout=60)
+
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    store = sqlite3.connect(path, timeout=60)
+    store.execute(
+        'CREATE TABLE IF NOT EXISTS snapshots ('
+        ' name TEXT, host TEXT, check_name TEXT,'
+        ' root TEXT, entries TEXT, fetched_at REAL,'
+        ' PRIMARY KEY (name, host, check_name))')
+    store.commit()
+    return store
+
+def load_snapshot(store, name, target, with_entries=True):
+    '''
+    Return the snapshot 'name' of the host 'target' as a dictionary
+    (key = check, value = digests), with the root digests only if
+    'with_entries' is False
+    '''
+    columns = 'check_name, root, fetched_at' + (
+        ', entries' if with_entries else '')
+    snapshot = dict()
+    for row in store.execute(
+            'SELECT {0} FROM snapshots WHERE name = ? AND host = ?'.format(
+                columns), (name, target)):
+        table = {'root': row[1], 'fetched_at': row[2]}
+        if with_entries:
+            table['entries'] = json.loads(row[3])
+        snapshot[row[0]] = table
+    return snapshot
+
+def save_snapshot(store, name, target, tables, fetched_at):
+    '''
+    Save the digests 'tables' (key = check) in the snapshot 'name'
+    of the host 'target'
+    '''
+    store.executemany(
+        'INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?)',
+        [(name, target, check, table['root'],
+          json.dumps(table['entries'], sort_keys=True),
+          table.get('fetched_at', fetched_at))
+            for check, table in tables.items()])
+    store.commit()
+
+def collect_host_data(target, store_path=None):
+    '''
+    Return the operating system, the cluster technology and the digests
+    of the system objects to be checked of the host 'target', by running
+    all the required functions in a single remote execution.
+    When a snapshot store is used, the tables whose root digest has not
+    changed since the last run are not transferred again but read from
+    the store.
+    '''
+    store = open_store(store_path, readonly=True) if store_path else None
+    try:
+        return _collect_host_data(target, store)
+    finally:
+        if store:
+            store.close()
+
+def _collect_host_data(target, store):
+    latest = load_snapshot(store, 'latest', target, with_entries=False) \
+        if store else dict()
+    known = dict((check.salt_module, latest[check.name]['root'])
+        for check in checks if check.name in latest)
+
+    ssh_client = salt.client.ssh.client.SSHClient()
+    tables = [check.salt_module for check in
+        sorted(checks, key=lambda check: -check.cost)]
+    data = saltstack_module_run(
+        ssh_client, target, 'cluster_check.collect',
+        ['cluster.is_active'] + tables,
+        kwargs={'grains': ','.join(grains_query), 'digest': ','.join(tables),
+                'parallel': len(tables) > 1, 'known': known})
+    if not data:
+        raise CommandExecutionError('No data returned')
+
+    def result(fun):
+        entry = data.get(fun, {})
+        if 'error' in entry:
+            raise CommandExecutionError(
+                '{0}: {1}'.format(fun, entry['error']))
+        return entry.get('return')
+
+    grains = data.get('grains', {})
+    os_version = '.'.join(str(n) for n in grains.get('osrelease_info', []))
+    os = "{0} {1}".format(grains.get('osfullname', ''), os_version)
+    osarch = grains.get('osarch', '')
+
+    is_cluster, cluster_tech = result('cluster.is_active')
+    if not is_cluster:
+        raise CommandExecutionError('Not a cluster node')
+
+    snapshot, unchanged = dict(), list()
+    for check in checks:
+        try:
+            snapshot[check.name] = result(check.salt_module)
+        except CommandExecutionError as err:
+            snapshot[check.name] = {'error': str(err)}
+            continue
+        if snapshot[check.name].get('unchanged'):
+            unchanged.append(check.name)
+    if unchanged:
+        previous = load_snapshot(store, 'latest', target)
+        for name in unchanged:
+            snapshot[name] = previous.get(name,
+                {'error': 'snapshot missing from the store'})
+
+    def digest(check):
+        '''Return the digests of the check or the error message'''
+        table = snapshot[check.name]
+        if 'error' in table or check.compare == 'values':
+            return table
+        return keys_digest(table)
+
+    digests = dict((check.name, digest(check)) for check in checks)
+    extra_grains = dict((grain, grains.get(grain))
+        for grain in grains_query[3:])
+    return ((os, osarch, cluster_tech, extra_grains), digests, snapshot)
+
+def fetch_entries(target, keys_per_module):
+    '''
+    Return the full content of the entries 'keys_per_module'
+    (a dictionary: salt module -> list of keys) of the host 'target'
+    '''
+    ssh_client = salt.client.ssh.client.SSHClient()
+    # a dictionary given as positional argument would be turned into
+    # key=value keyword arguments by salt-ssh
+    data = saltstack_module_run(
+        ssh_client, target, 'cluster_check.fetch',
+        kwargs={'tables': json.dumps(keys_per_module)})
+    records = dict()
+    for salt_module in keys_per_module:
+        entry = data.get(salt_module, {})
+        if 'error' in entry:
+            raise CommandExecutionError(
+                '{0}: {1}'.format(salt_module, entry['error']))
+        records[salt_module] = entry.get('return', {})
+    return records
+
+def table_group():
+    '''
+    Return an empty group of tables, holding the tables of a check
+    returned by all the hosts:
+     - reference: the entry digests of the first table received
+     - tables: key = root digest, value = (delta, hosts), where delta
+       is the sparse list of the entries differing from the reference
+       (key = entry, value = digest, or None if the entry is missing)
+     - votes: key = entry, value = {digest: number of hosts}
+     - hosts: the number of hosts
+    '''
+    return {'reference': None, 'tables': {}, 'votes': {}, 'hosts': 0}
+
+def add_host_digests(variants, target, digests):
+    '''
+    Record the table digests of the host 'target' in 'variants'
+    (key = check, value = table group) as soon as they are received.
+    The votes of the majority baseline are updated host by host, and
+    each distinct table is only kept as a delta against the reference
+    table, so that the memory used grows with the differences between
+    the hosts, and not with the number of hosts.
+    '''
+    for check, table in digests.items():
+        if 'error' in table:
+            continue
+        group = variants.setdefault(check, table_group())
+        entries, votes = table['entries'], group['votes']
+        group['hosts'] += 1
+        for key, digest in entries.items():
+            counter = votes.setdefault(key, {})
+            counter[digest] = counter.get(digest, 0) + 1
+
+        if table['root'] in group['tables']:
+            group['tables'][table['root']][1].append(target)
+            continue
+        reference = group['reference']
+        if reference is None:
+            group['reference'], delta = entries, dict()
+        else:
+            delta = dict((key, digest) for key, digest in entries.items()
+                if reference.get(key) != digest)
+            delta.update((key, None) for key in reference
+                if key not in entries)
+        group['tables'][table['root']] = (delta, [target])
+
+def variant_digest(group, root, key):
+    '''
+    Return the digest of the entry 'key' in the table 'root' of 'group',
+    or None if the entry is missing
+    '''
+    delta = group['tables'][root][0]
+    return delta[key] if key in delta else group['reference'].get(key)
+
+def majority_baseline(group):
+    '''
+    Return the majority baseline of the tables of 'group' as a
+    dictionary: key = entry, value = digest.
+    An entry belongs to the baseline when it is present on more than half
+    of the hosts; its digest is the one reported by more than half of the
+    hosts having the entry, or None when there is no such digest.
+    '''
+    baseline = dict()
+    for key, counter in group['votes'].items():
+        present = sum(counter.values())
+        if present * 2 > group['hosts']:
+            baseline[key] = next((digest for digest, votes in counter.items()
+                if votes * 2 > present), None)
+    return baseline
+
+def union_baseline(group):
+    '''
+    Return the union of the entries of the tables of 'group': key = entry,
+    value = the digest when all the hosts having this entry agree,
+    None otherwise
+    '''
+    return dict((key, next(iter(counter)) if len(counter) == 1 else None)
+        for key, counter in group['votes'].items())
+
+def compare_digests(group, majority=False):
+    '''
+    Compare each distinct table of 'group' (see add_host_digests) against
+    the baseline and return a dictionary (key = root digest) of the tuples
+    (missing, extra, different entries) and the baseline itself.
+    With the majority baseline, an entry without a majority digest is
+    never reported as different.
+    The reference table is compared in full, the other tables only on
+    the entries of their delta.
+    '''
+    tables = group['tables']
+    if len(tables) <= 1:
+        # all the hosts have an identical table
+        return (dict((root, (set(), set(), set())) for root in tables), {})
 
-    def get_objs(ssh_client, target, salt_module):
-        '''
-        Return the system objects locally configured on target
-        '''
-        return saltstack_module_run(
-            ssh_client, target, salt_module)
+    baseline = (majority_baseline(group) if majority
+        else union_baseline(group))
 
+    def classify(key, digest, deviations):
+        missing, extra, different = deviations
+        for entries in deviations:
+            entries.discard(key)
+        if key in baseline:
+            if digest is None:
+                missing.add(key)
+            elif digest != baseline[key] and not (
+                    majority and baseline[key] is None):
+                different.add(key)
+        elif digest is not None:
+            extra.add(key)
+
+    reference = group['reference']
+    reference_deviations = (set(), set(), set())
+    for key in baseline:
+        classify(key, reference.get(key), reference_deviations)
+    for key, digest in reference.items():
+        if key not in baseline:
+            classify(key, digest, reference_deviations)
+
+    deviations = dict()
+    for root, (delta, _) in tables.items():
+        deviations[root] = tuple(set(entries)
+            for entries in reference_deviations)
+        for key, digest in delta.items():
+            classify(key, digest, deviations[root])
+    return (deviations, baseline)
+
+def format_differences(key, record, reference):
+    '''
+    Return the fields of the entry 'key' that differ between 'record'
+    and the records in the list 'reference'
+    '''
+    records = [record] + reference
+    if not all(isinstance(rec, dict) for rec in records):
+        return '{0}: {1}'.format(key, record)
+    fields = set(itertools.chain(*[rec.keys() for rec in records]))
+    differences = [field for field in sorted(fields)
+        if len(set(repr(rec.get(field)) for rec in records)) > 1]
+    return '{0}: {1}'.format(key, ', '.join('{0}={1}'.format(
+        field, record.get(field, '')) for field in differences))
+
+def checkup(pool, variants, cluster_hostnames, majority=False):
+    '''
+    Compare the tables of all the hosts: identical tables are detected
+    by their root digest, and only the entries with a different value
+    are fetched in full, from one host per distinct table, to report the
+    differences.  The hosts are compared either with the union of all
+    the hosts, or with the majority of them when 'majority' is True.
+    Return the number of hosts that failed.
+    '''
     def print_deviations(text, target, deviations):
         print('{0}: {1}:{2}'.format(target, text,
               ' OK' if not deviations else
               ''.join(['\n - ' + dev for dev in sorted(deviations)])))
 
-    for check, salt_module in checks:
-        print('*** Checking {0}'.format(check))
-        objs_per_host = dict(
-            (target, get_objs(ssh_client, target, salt_module))
-                for target in cluster_hostnames)
-        all_objs = set(itertools.chain(*[
-            objs_per_host.get(target).keys() for target in cluster_hostnames]))
+    # one host is enough to get the entries of a distinct table
+    representative = lambda tables, root: tables[root][1][0]
+
+    results, keys_per_host = dict(), dict()
+    def _fetch_from(target, salt_module, key):
+        keys_per_host.setdefault(target, {}).setdefault(
+            salt_module, set()).add(key)
+
+    def is_reference(group, root, other, key, baseline):
+        '''Whether the table 'other' holds a reference value of 'key' '''
+        digest = variant_digest(group, other, key)
+        return other != root and digest is not None and (
+            not majority or digest == baseline[key])
+
+    for check in checks:
+        salt_module = check.salt_module
+        group = variants.get(check.name, table_group())
+        tables = group['tables']
+        deviations, baseline = compare_digests(group, majority)
+        results[check.name] = (deviations, baseline)
+        for root, (_, _, different) in deviations.items():
+            for key in different:
+                _fetch_from(representative(tables, root), salt_module, key)
+                # the reference value(s) of the entry
+                for other, (_, targets) in tables.items():
+                    if is_reference(group, root, other, key, baseline):
+                        _fetch_from(targets[0], salt_module, key)
+
+    records_per_host, failures = dict(), 0
+    for target, records, error in run_on_hosts(pool,
+            lambda target: fetch_entries(target, dict(
+                (salt_module, sorted(keys)) for salt_module, keys in
+                    keys_per_host[target].items())),
+            sorted(keys_per_host)):
+        if error:
+            failures += 1
+            print('{0}: error: {1}'.format(target, error))
+            continue
+        records_per_host[target] = records
+
+    for check in checks:
+        print('*** Checking {0}'.format(check.name))
+        salt_module = check.salt_module
+        group = variants.get(check.name, table_group())
+        tables = group['tables']
+        deviations, baseline = results[check.name]
+        record = lambda root, key: records_per_host.get(
+            representative(tables, root), {}).get(salt_module, {}).get(key)
+
+        def differences(root, different):
+            for key in different:
+                reference = [record(other, key) for other in tables
+                    if is_reference(group, root, other, key, baseline)]
+                yield format_differences(
+                    key, record(root, key), [r for r in reference if r])
+
+        if majority:
+            identical = sum(len(tables[root][1])
+                for root, devs in deviations.items() if not any(devs))
+            print('{0}/{1} hosts identical to the majority'.format(
+                identical, sum(len(targets) for _, targets in tables.values())))
+            undecided = sorted(key for key, digest in baseline.items()
+                if digest is None)
+            if undecided:
+                print('no majority in {0}:{1}'.format(check.name,
+                    ''.join(['\n - ' + key for key in undecided])))
 
         for target in cluster_hostnames:
-            target_objs = set(objs_per_host.get(target).keys())
-            missing = all_objs.difference(target_objs)
-            print_deviations('missing {0}'.format(check), target, missing)
+            root = next((root for root, (_, targets) in tables.items()
+                if target in targets), None)
+            if root is None:
+                continue
+            missing, extra, different = deviations[root]
+            if majority:
+                if not any(deviations[root]):
+                    continue
+                print_deviations(
+                    'deviations in {0}'.format(check.name), target,
+                    ['missing ' + key for key in missing] +
+                    ['extra ' + key for key in extra] +
+                    ['different ' + diff
+                        for diff in differences(root, different)])
+                continue
+            print_deviations('missing {0}'.format(check.name), target,
+                missing)
+            if different:
+                print_deviations(
+                    'different {0}'.format(check.name), target,
+                    list(differences(root, different)))
 
-def get_items(target, infos, query):
-    j = json.loads(json.dumps(infos))
-    return dict(
-        [(q, j.get(target, {}).get('return', {}).get(q, "")) for q in query])
+    return failures
 
-def get_salt_grains(ssh_client, target):
+def baseline_drift(baseline, digests):
     '''
-    Return all the grains provided by SaltStack for the host 'target'
+    Return the entries added, removed and changed in the table 'digests'
+    since the snapshot 'baseline'
     '''
-    # returns one item per target (host)
-    return ssh_client.cmd_iter(target, 'grains.items')
+    entries, previous = digests['entries'], baseline['entries']
+    added = set(key for key in entries if key not in previous)
+    removed = set(key for key in previous if key not in entries)
+    changed = set(key for key, digest in entries.items()
+        if key in previous and previous[key] != digest)
+    return (added, removed, changed)
 
-def main(cluster_hostnames):
-    ssh_client = salt.client.ssh.client.SSHClient()
-    grains = dict()
-    for target in cluster_hostnames:
-        for infos in get_salt_grains(ssh_client, target):
-            # NOTE: dump all the grabbed data just fot debugging
-            #print(json.dumps(infos, sort_keys=True, indent=2, separators=(',', ': ')))
-            grains = get_items(target, infos, (
-                'osarch',
-                'osfullname',
-                'osrelease_info'))
-
-        os_version = '.'.join(str(n) for n in grains['osrelease_info'])
-        os = "{0} {1}".format(grains['osfullname'], os_version)
-        osarch = grains['osarch']
-
-        is_cluster, cluster_tech = saltstack_module_run(
-            ssh_client, target,'cluster.is_active')
-        if not is_cluster:
-            die('{0}: Not a cluster node'.format(target))
-
-        print("{0}:\n - os: {1} ({2})\n - cluster tecnology: {3}".format(
-            target, os, osarch, cluster_tech))
-
-    checkup(ssh_client, cluster_hostnames)
+def print_baseline_drift(store, name, target, snapshot):
+    '''
+    Print the differences between the current 'snapshot' of 'target'
+    and its stored snapshot 'name'.  Return False if the snapshot
+    'name' does not exist for this host
+    '''
+    baseline = load_snapshot(store, name, target)
+    if not baseline:
+        print('{0}: error: no snapshot {1} for this host'.format(
+            target, name))
+        return False
+    for check in checks:
+        if 'error' in snapshot[check.name] or check.name not in baseline:
+            continue
+        current, previous = snapshot[check.name], baseline[check.name]
+        if check.compare == 'keys':
+            current, previous = keys_digest(current), keys_digest(previous)
+        if current['root'] == previous['root']:
+            print('{0}: {1} since {2}: OK'.format(target, check.name, name))
+            continue
+        added, removed, changed = baseline_drift(previous, current)
+        print('{0}: {1} since {2}:{3}'.format(target, check.name, name,
+            ''.join(['\n - ' + dev for dev in
+                ['added ' + key for key in sorted(added)] +
+                ['removed ' + key for key in sorted(removed)] +
+                ['changed ' + key for key in sorted(changed)]])))
+    return True
+
+def main(cluster_hostnames, jobs, majority=False,
+         store_path=None, save_baseline=None, since_baseline=None):
+    store = open_store(store_path) if store_path else None
+    pool = ThreadPool(max(1, min(jobs, len(cluster_hostnames))))
+    try:
+        variants, cluster_nodes, failures = dict(), list(), 0
+        for target, data, error in run_on_hosts(pool,
+                lambda target: collect_host_data(target, store_path),
+                cluster_hostnames):
+            if error:
+                failures += 1
+                print('{0}: error: {1}'.format(target, error))
+                continue
+            infos, digests, snapshot = data
+            if store:
+                now = time.time()
+                tables = dict((check, table)
+                    for check, table in snapshot.items() if 'error' not in table)
+                save_snapshot(store, 'latest', target, dict(
+                    (check, table) for check, table in tables.items()
+                        if 'fetched_at' not in table), now)
+                if save_baseline:
+                    save_snapshot(store, save_baseline, target, tables, now)
+            # the digests are merged as soon as they are received
+            add_host_digests(variants, target, digests)
+            cluster_nodes.append(target)
+            os, osarch, cluster_tech, extra_grains = infos
+            print("{0}:\n - os: {1} ({2})\n - cluster tecnology: {3}".format(
+                target, os, osarch, cluster_tech))
+            for grain in sorted(extra_grains):
+                print(' - {0}: {1}'.format(grain, extra_grains[grain]))
+            errors = [(check, table['error'])
+                for check, table in sorted(digests.items())
+                    if 'error' in table]
+            for check, error in errors:
+                print(' - error: {0} check skipped: {1}'.format(check, error))
+            if errors:
+                failures += 1
+            if since_baseline and not print_baseline_drift(
+                    store, since_baseline, target, snapshot):
+                failures += 1
+
+        if not since_baseline:
+            cluster_nodes.sort(key=cluster_hostnames.index)
+            failures += checkup(pool, variants, cluster_nodes, majority)
+    finally:
+        pool.close()
+        pool.join()
+        if store:
+            store.close()
+
+    return 1 if failures else 0
 
 if __name__ == '__main__':
-    cluster_hostnames = None
+    profile_log = None
+    cluster_hostnames, jobs, majority = None, 8, False
+    store_path, save_baseline, since_baseline = None, None, None
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'c:h',
-            ["cluster=", "help"])
+        opts, args = getopt.getopt(sys.argv[1:], 'C:c:g:hj:mps:',
+            ["checks=", "cluster=", "grains=", "help", "jobs=", "majority",
+             "profile", "profile-log=", "save-baseline=", "since-baseline=",
+             "store="])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -140,17 +692,55 @@ if __name__ == '__main__':
         if o in ('-h', '--help'):
             usage()
             sys.exit()
+        elif o in ('-C', '--checks'):
+            names = a.strip().split(',')
+            if names == ['all']:
+                names = sorted(check_registry)
+            unknown = [name for name in names if name not in check_registry]
+            if unknown:
+                die('Unknown checks: {0} (available: {1})'.format(
+                    ','.join(unknown), ','.join(sorted(check_registry))))
+            checks = [check_registry[name] for name in names]
         elif o in ('-c', '--cluster'):
             cluster_hostnames = a.strip().split(',')
+        elif o in ('-g', '--grains'):
+            # additional grains to be fetched
+            grains_query.extend(grain for grain in a.strip().split(',')
+                if grain and grain not in grains_query)
+        elif o in ('-j', '--jobs'):
+            try:
+                jobs = int(a)
+            except ValueError:
+                die('Invalid number of jobs: {0}'.format(a))
+        elif o in ('-m', '--majority'):
+            majority = True
+        elif o in ('-s', '--store'):
+            store_path = a
+        elif o == '--save-baseline':
+            save_baseline = a
+        elif o == '--since-baseline':
+            since_baseline = a
+        elif o in ('-p', '--profile'):
+            profile_calls = []
+        elif o == '--profile-log':
+            profile_calls, profile_log = [], a
         else:
             die('Unhandled command line option: {0}'.format(o))
 
     if not cluster_hostnames: usage(); sys.exit(2)
+    if (save_baseline or since_baseline) and not store_path:
+        die('--save-baseline and --since-baseline require --store')
+    if 'latest' in (save_baseline, since_baseline):
+        die('The snapshot name "latest" is reserved')
     if os.geteuid() != 0:
         die('This script must be run as root')
 
     try:
-        main(cluster_hostnames)
+        exitcode = main(cluster_hostnames, jobs, majority,
+            store_path, save_baseline, since_baseline)
     except KeyboardInterrupt:
         die(3, 'Exiting on user request')
-    sys.exit(0)
+    finally:
+        if profile_calls is not None:
+            print_profile(profile_calls, profile_log)
+    sys.exit(exitcode)
@@ -55,31 +55,47 @@ def usage(human_readable=True):
     Swap = collections.namedtuple('Swap', cols)
     fmt = lambda num: _sizeof_fmt(num) if human_readable else int(num)
 
+    if 'fsinfo.dm_topology' in __salt__:
+        dm_topology, swap_devices = __salt__['fsinfo.dm_topology'](), None
+    else:
+        # the fsinfo module is not synced: fall back to blkid
+        blkid_out = __salt__['disk.blkid']()
+        dm_topology, swap_devices = {}, [dev
+            for dev, details in blkid_out.items()
+                if details.get('TYPE', '') == 'swap']
+
     def swap_info(swap):
-        return {
+        infos = {
             'available': fmt(int(swap.size) - int(swap.used)),
             'device': swap.filename,
             'priority': swap.priority,
             'size': fmt(swap.size),
             'used': fmt(swap.used)
         }
-
-    blkid_out = __salt__['disk.blkid']()
-    swap_devices = [dev for dev, details in blkid_out.items()
-                       if details.get('TYPE', '') == 'swap']
+        dm_infos = dm_topology.get(os.path.basename(swap.filename), {})
+        if dm_infos.get('multipath'):
+            infos['multipath'] = dm_infos['multipath']
+        return infos
 
     def to_blkid(dev):
         '''
-        This function Try to map the dm device to the lvm one (in case of lvm
-        partitioning).  Ex: /dev/dm-1 --> /dev/mapper/rootvg-swaplv
+        Map the dm device to the lvm one (in case of lvm partitioning),
+        by using the device-mapper topology read from sysfs, or the swap
+        devices reported by blkid without the fsinfo module.
+        Ex: /dev/dm-1 --> /dev/mapper/rootvg-swaplv
         '''
-        for blkdev in swap_devices:
-            try:
-                rl =__salt__['file.readlink'](blkdev, canonicalize=True)
-                if rl == dev:
-                    return blkdev
-            except:
-                pass
+        if swap_devices is not None:
+            for blkdev in swap_devices:
+                try:
+                    rl = __salt__['file.readlink'](blkdev, canonicalize=True)
+                    if rl == dev:
+                        return blkdev
+                except:
+                    pass
+            return dev
+        name = dm_topology.get(os.path.basename(dev), {}).get('name')
+        if dev.startswith('/dev/dm-') and name:
+            return '/dev/mapper/' + name
         return dev
 
     header = lambda line: line.startswith('Filename')